@@ -0,0 +1,251 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from match_history import fetch_player_battles
+
+ARCHIVE_CHUNK = 5000  # 每个事务搬运的对战数
+ARCHIVED_TABLES = ("ratings", "battles", "teams", "settlements")
+SEASON_NAME = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+RANKING_ORDER = """
+    rating DESC,
+    CASE WHEN wins + losses > 0 THEN wins * 1.0 / (wins + losses) ELSE 0 END DESC,
+    wins DESC, player_id
+"""
+
+
+def archive_path(directory: str, season: str) -> str:
+    return os.path.join(directory, f"season_{season}.db")
+
+
+# ===================== 赛季切换（在写线程上执行） =====================
+def prepare_archive(conn: sqlite3.Connection, path: str, season: str, cutoff: str) -> str:
+    """建立归档文件并以 archive 附加到写连接，返回本赛季的截止时间（中断后重跑时沿用首次的值）"""
+    # 按线上库的建表语句建表，归档与线上表结构一致，可直接 INSERT ... SELECT *
+    placeholders = ", ".join("?" for _ in ARCHIVED_TABLES)
+    schema = conn.execute(f"""
+        SELECT name, sql FROM main.sqlite_master
+        WHERE tbl_name IN ({placeholders}) AND sql IS NOT NULL
+        ORDER BY type DESC
+    """, ARCHIVED_TABLES).fetchall()
+
+    archive = sqlite3.connect(path)
+    try:
+        existing = {row[0] for row in archive.execute("SELECT name FROM sqlite_master")}
+        for name, sql in schema:
+            if name not in existing:
+                archive.execute(sql)
+        archive.execute("""
+        CREATE TABLE IF NOT EXISTS season_info (
+            season TEXT PRIMARY KEY,
+            cutoff TEXT NOT NULL,
+            completed_at TEXT,
+            battles INTEGER,
+            players INTEGER
+        )""")
+        archive.execute("INSERT OR IGNORE INTO season_info (season, cutoff) VALUES (?, ?)", (season, cutoff))
+        archive.commit()
+        cutoff, completed_at = archive.execute(
+            "SELECT cutoff, completed_at FROM season_info WHERE season = ?", (season,)).fetchone()
+    finally:
+        archive.close()
+    if completed_at is not None:
+        raise ValueError("该赛季已归档")
+
+    conn.execute("ATTACH DATABASE ? AS archive", (path,))
+    return cutoff
+
+
+def copy_ratings_chunk(conn: sqlite3.Connection, after: Optional[str], limit: int) -> Tuple[int, Optional[str]]:
+    """按 player_id 顺序复制一块评分到归档，返回 (行数, 本块最后的 player_id)"""
+    lower = "player_id > ?" if after is not None else "1"
+    bounds = [after] if after is not None else []
+    keys = conn.execute(f"SELECT player_id FROM main.ratings WHERE {lower} ORDER BY player_id LIMIT ?",
+                        bounds + [limit]).fetchall()
+    if not keys:
+        return 0, after
+    last = keys[-1][0]
+    conn.execute(f"""
+        INSERT OR REPLACE INTO archive.ratings
+        SELECT * FROM main.ratings WHERE {lower} AND player_id <= ?
+    """, bounds + [last])
+    conn.commit()
+    return len(keys), last
+
+
+def archive_battles_chunk(conn: sqlite3.Connection, cutoff: str, limit: int, active: List[str]) -> int:
+    """把截止时间前最早的一块已结算对战（连同队伍与结算记录）移入归档，返回移动的行数
+
+    进行中（active 中）或尚未写入胜者的对战留在线上库，结束后照常结算，下个赛季再归档。
+    """
+    in_chunk = "IN (SELECT value FROM json_each(?))"
+    ids = [row[0] for row in conn.execute(f"""
+        SELECT battle_id FROM main.battles
+        WHERE timestamp < ? AND winner IS NOT NULL AND battle_id NOT {in_chunk}
+        ORDER BY timestamp LIMIT ?
+    """, (cutoff, json.dumps(active), limit))]
+    if not ids:
+        return 0
+    chunk = json.dumps(ids)
+
+    conn.execute(f"INSERT OR IGNORE INTO archive.battles SELECT * FROM main.battles WHERE battle_id {in_chunk}",
+                 (chunk,))
+    conn.execute(f"""
+        INSERT OR IGNORE INTO archive.teams
+        SELECT * FROM main.teams WHERE team_hash IN (
+            SELECT team1_hash FROM main.battles WHERE battle_id {in_chunk}
+            UNION SELECT team2_hash FROM main.battles WHERE battle_id {in_chunk}
+        )
+    """, (chunk, chunk))
+    conn.execute(f"INSERT OR IGNORE INTO archive.settlements SELECT * FROM main.settlements WHERE battle_id {in_chunk}",
+                 (chunk,))
+    # WAL 模式下跨库事务对两个文件不是整体原子的：先提交副本再删除，中断后重跑只会重复复制
+    conn.commit()
+
+    conn.execute(f"DELETE FROM main.settlements WHERE battle_id {in_chunk}", (chunk,))
+    conn.execute(f"DELETE FROM main.battles WHERE battle_id {in_chunk}", (chunk,))
+    conn.commit()
+    return len(ids)
+
+
+def finish_rollover(conn: sqlite3.Connection, season: str, ratings_copied_at: str, completed_at: str,
+                    carry_over: float, default_rating: int, player_columns: str) -> Dict:
+    """在一个事务内补齐最终评分、重置线上评分并标记归档完成，返回归档统计与重置后的评分"""
+    conn.execute("BEGIN")
+    try:
+        # 分块复制期间仍有结算，归档前把这段时间变化过的评分再同步一次
+        conn.execute("INSERT OR REPLACE INTO archive.ratings SELECT * FROM main.ratings WHERE last_active >= ?",
+                     (ratings_copied_at,))
+        if carry_over > 0:
+            conn.execute("""
+                UPDATE main.ratings
+                SET rating = ? + CAST(ROUND((COALESCE(rating, ?) - ?) * ?) AS INTEGER), wins = 0, losses = 0
+            """, (default_rating, default_rating, default_rating, carry_over))
+        else:
+            conn.execute("DELETE FROM main.ratings")
+        # 队伍只保留仍被线上对战引用的
+        conn.execute("""
+            DELETE FROM main.teams WHERE team_hash NOT IN (
+                SELECT team1_hash FROM main.battles WHERE team1_hash IS NOT NULL
+                UNION SELECT team2_hash FROM main.battles WHERE team2_hash IS NOT NULL
+            )
+        """)
+        battles = conn.execute("SELECT COUNT(*) FROM archive.battles").fetchone()[0]
+        players = conn.execute("SELECT COUNT(*) FROM archive.ratings").fetchone()[0]
+        conn.execute("UPDATE archive.season_info SET completed_at = ?, battles = ?, players = ? WHERE season = ?",
+                     (completed_at, battles, players, season))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    rows = conn.execute(f"SELECT {player_columns} FROM main.ratings").fetchall()
+    return {"season": season, "battles": battles, "players": players, "ratings": [dict(row) for row in rows]}
+
+
+def detach_archive(conn: sqlite3.Connection):
+    if conn.in_transaction:
+        conn.rollback()
+    if any(row[1] == "archive" for row in conn.execute("PRAGMA database_list")):
+        conn.execute("DETACH DATABASE archive")
+
+
+# ===================== 历史查询 =====================
+class SeasonArchive:
+    """一个已完成的赛季归档；归档文件不再变化，以只读、免锁方式打开"""
+
+    def __init__(self, path: str):
+        self.path = path
+        uri = Path(path).resolve().as_uri() + "?mode=ro&immutable=1"
+        self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()  # 多个读线程共用这一个连接
+        info = self.conn.execute("SELECT * FROM season_info").fetchone()
+        self.season = info["season"]
+        self.cutoff = info["cutoff"]  # 归档中所有对战都早于该时间
+        self.info = dict(info)
+
+    def query(self, fn: Callable, *args):
+        with self._lock:
+            return fn(self.conn, *args)
+
+    def close(self):
+        self.conn.close()
+
+
+class SeasonArchives:
+    """已归档的全部赛季，按截止时间由新到旧排列"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._archives: Tuple[SeasonArchive, ...] = ()
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        archives = []
+        for name in os.listdir(self.directory):
+            if not (name.startswith("season_") and name.endswith(".db")):
+                continue
+            try:
+                archive = SeasonArchive(os.path.join(self.directory, name))
+            except sqlite3.Error:
+                continue  # 未完成或损坏的归档
+            if archive.info["completed_at"] is None:
+                archive.close()
+                continue
+            archives.append(archive)
+        self._set(archives)
+
+    def add(self, path: str):
+        self._set(list(self._archives) + [SeasonArchive(path)])
+
+    def _set(self, archives: List[SeasonArchive]):
+        # 整体替换元组，读线程无需加锁即可遍历
+        self._archives = tuple(sorted(archives, key=lambda a: a.cutoff, reverse=True))
+
+    def get(self, season: str) -> Optional[SeasonArchive]:
+        return next((a for a in self._archives if a.season == season), None)
+
+    def seasons(self) -> List[Dict]:
+        return [archive.info for archive in self._archives]
+
+    def first(self, fn: Callable, *args):
+        """依次在各赛季归档上执行 fn，返回第一个非 None 的结果"""
+        for archive in self._archives:
+            result = archive.query(fn, *args)
+            if result is not None:
+                return result
+        return None
+
+    def player_battles(self, conn: sqlite3.Connection, player_id: str, limit: int,
+                       before: Optional[Tuple[str, str]] = None) -> List[Dict]:
+        """线上库与各赛季归档合并后的玩家对战记录，分页键与 fetch_player_battles 相同"""
+        rows = fetch_player_battles(conn, player_id, limit, before)
+        for archive in self._archives:
+            # 归档中的对战都早于其截止时间，已有满页且不会被更早的记录挤出时即可停止
+            if len(rows) >= limit and rows[limit - 1]["timestamp"] >= archive.cutoff:
+                break
+            rows += archive.query(fetch_player_battles, player_id, limit, before)
+            rows.sort(key=lambda row: (row["timestamp"], row["battle_id"]), reverse=True)
+            del rows[limit:]
+        return rows
+
+    def close(self):
+        for archive in self._archives:
+            archive.close()
+        self._archives = ()
+
+
+def fetch_season_ranking(conn: sqlite3.Connection, page: int, per_page: int) -> Tuple[int, List[Dict]]:
+    """赛季归档中的最终排名"""
+    total = conn.execute("SELECT COUNT(*) FROM ratings").fetchone()[0]
+    rows = conn.execute(f"""
+        SELECT player_id, player_name, rating, wins, losses, last_server
+        FROM ratings ORDER BY {RANKING_ORDER} LIMIT ? OFFSET ?
+    """, (per_page, (page - 1) * per_page)).fetchall()
+    offset = (page - 1) * per_page
+    return total, [dict(row, global_rank=offset + i + 1) for i, row in enumerate(rows)]
@@ -1,5 +1,6 @@
 import asyncio
 import random
+from contextlib import contextmanager
 from typing import Callable
 import time
 import uuid
@@ -369,7 +370,13 @@ ABILITY_EFFECTS = {
     }
 }
 
+TURN_TIMEOUT = 180  # 回合超时（秒）
+
+
 class BattleInstance:
+    # 快照中不保存的回调与定时器
+    _TRANSIENT_FIELDS = ("log_callback", "state_update_callback", "turn_timeout", "_event_buffer")
+
     def __init__(self, battle_id: str, player1: dict, player2: dict, mode: str, log_callback: Callable):
         self.battle_id = battle_id
         self.mode = mode
@@ -383,10 +390,13 @@ class BattleInstance:
         self.state_update_callback = None  # 状态更新回调
         self.action_choices = {player1["player_id"]: False, player2["player_id"]: False}  # 追踪玩家行动选择状态
         self.turn_timeout = asyncio.get_event_loop().call_later(
-            180,  # 3分钟超时
+            TURN_TIMEOUT,  # 3分钟超时
             self.handle_turn_timeout
         )  # 回合超时任务
         self.turn_start_time = time.time()  # 回合开始时间
+        self.revision = 0  # 状态每次变化加一，用于判断快照是否需要重新序列化
+        self.event_seq = 0  # 对战内事件的递增序号
+        self._event_buffer = None  # 非 None 时事件先缓冲，批次结束后一次交给 log_callback
 
         # 初始化玩家状态
         self.players = {
@@ -421,6 +431,36 @@ class BattleInstance:
         if self.ended:  # 如果已因数据超限结束战斗，则直接返回
             return
 
+    def to_snapshot(self) -> dict:
+        """导出对战状态（不含回调与定时器）"""
+        state = {k: v for k, v in self.__dict__.items() if k not in self._TRANSIENT_FIELDS}
+        state["turn_timeout_armed"] = self.turn_timeout is not None
+        return state
+
+    @classmethod
+    def from_snapshot(cls, state: dict, taken_at: float, log_callback: Callable) -> "BattleInstance":
+        """由快照重建对战，回合超时按快照时的剩余时长重新计时，停机时间不计入"""
+        battle = cls.__new__(cls)
+        state = dict(state)
+        timeout_armed = state.pop("turn_timeout_armed")
+        battle.event_seq = 0
+        battle.__dict__.update(state)
+        battle._event_buffer = None
+
+        now = time.time()
+        turn_elapsed = max(0.0, taken_at - battle.turn_start_time)
+        battle.start_time = now - max(0.0, taken_at - battle.start_time)
+        battle.turn_start_time = now - turn_elapsed
+        battle.log_callback = log_callback
+        battle.state_update_callback = None
+        battle.turn_timeout = None
+        if timeout_armed and not battle.ended:
+            battle.turn_timeout = asyncio.get_event_loop().call_later(
+                max(0.0, TURN_TIMEOUT - turn_elapsed),
+                battle.handle_turn_timeout
+            )
+        return battle
+
     def _check_pokemon_stats(self):
         """检查宝可梦数据是否超过500以及等级，超过则判负"""
         MAX_STAT = 500  # 最大允许值
@@ -498,14 +538,32 @@ class BattleInstance:
         player_data["switch_slot"] = slot
         player_data["action"] = {"type": "switch"}  # 标记行动已选择
         self.action_choices[player_id] = True
+        self.revision += 1
 
     def _log_event(self, event_type: str, data: dict = None):
-        """记录对战事件"""
-        if self.log_callback:
-            message = {"event_type": event_type}
-            if data:
-                message.update(data)
-            self.log_callback(message)
+        """记录对战事件（log_callback 收到的是按序号排列的事件列表）"""
+        message = {"event_type": event_type, "seq": self.event_seq}
+        self.event_seq += 1
+        if data:
+            message.update(data)
+        if self._event_buffer is not None:
+            self._event_buffer.append(message)
+        elif self.log_callback:
+            self.log_callback([message])
+
+    @contextmanager
+    def batched_events(self):
+        """块内产生的事件先缓冲，结束时作为一批交给 log_callback；可嵌套"""
+        if self._event_buffer is not None:
+            yield
+            return
+        self._event_buffer = []
+        try:
+            yield
+        finally:
+            events, self._event_buffer = self._event_buffer, None
+            if events and self.log_callback:
+                self.log_callback(events)
 
     def _init_pokemon(self, pokemon: dict) -> dict:
         """初始化宝可梦战斗状态"""
@@ -671,6 +729,7 @@ class BattleInstance:
         """设置玩家行动"""
         self.players[player_id]["action"] = action
         self.action_choices[player_id] = True
+        self.revision += 1
 
         # 通知对手玩家已选择行动
         self._log_event("opponent_action_taken", {
@@ -682,9 +741,14 @@ class BattleInstance:
         return all(p["action"] is not None for p in self.players.values())
 
     def process_turn(self):
-        """处理一个回合"""
+        """处理一个回合，本回合的事件合并为一批发出"""
+        with self.batched_events():
+            self._process_turn()
+
+    def _process_turn(self):
         if self.ended:
             return
+        self.revision += 1
 
         # 取消当前回合的超时任务
         if self.turn_timeout:
@@ -786,13 +850,18 @@ class BattleInstance:
         if not self.ended:
             self.turn_start_time = time.time()
             self.turn_timeout = asyncio.get_event_loop().call_later(
-                180,  # 3分钟超时
+                TURN_TIMEOUT,  # 3分钟超时
                 self.handle_turn_timeout
             )
 
     def handle_turn_timeout(self):
+        with self.batched_events():
+            self._handle_turn_timeout()
+
+    def _handle_turn_timeout(self):
         if self.ended:
             return
+        self.revision += 1
 
         # 记录超时日志
         self._log_event("turn_timeout")
@@ -1513,4 +1582,4 @@ class BattleInstance:
                     self._log_event("status_ended", {
                         "pokemon": pokemon['name'],
                         "status": "confusion"
-                    })
\ No newline at end of file
+                    })
\ No newline at end of file
@@ -0,0 +1,303 @@
+"""
+匹配基准测试与仿真
+
+用合成玩家填充匹配队列，直接驱动 main.check_matches（全量匹配与加入触发的增量匹配），评分来自预先写入的评分缓存，
+对战创建被替换为只记录配对结果，因此测得的只是匹配器本身的开销。
+
+用法示例:
+    python benchmark_matchmaking.py
+    python benchmark_matchmaking.py --sizes 1000,50000 --servers 20 --distribution skewed
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from typing import Dict, List
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_server_module():
+    """在临时目录中导入 main，避免写入真实的日志和数据库"""
+    work_dir = tempfile.mkdtemp(prefix="matchmaking-bench-")
+    config_path = os.path.join(BASE_DIR, "config.json")
+    if os.path.exists(config_path):
+        shutil.copy(config_path, work_dir)
+    os.chdir(work_dir)
+    sys.path.insert(0, BASE_DIR)
+    import main
+    import logging
+    logging.getLogger("matchmaking").setLevel(logging.WARNING)
+    return main, work_dir
+
+
+class VirtualClock:
+    """仿真用时钟，替换 main 中的 time 模块"""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self) -> float:
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def draw_rating(rng: random.Random, distribution: str) -> int:
+    if distribution == "normal":
+        value = rng.gauss(1000, 150)
+    elif distribution == "skewed":
+        # 大部分玩家停留在初始分附近，少量高分长尾
+        value = 850 + rng.lognormvariate(5.0, 0.6)
+    elif distribution == "bimodal":
+        value = rng.gauss(950, 80) if rng.random() < 0.7 else rng.gauss(1450, 120)
+    else:
+        raise ValueError(f"未知的评分分布: {distribution}")
+    return max(0, int(value))
+
+
+def server_weights(servers: int) -> List[float]:
+    # 按 Zipf 分布分配玩家，模拟少数大服占据大部分队列
+    return [1.0 / (k + 1) for k in range(servers)]
+
+
+class Workload:
+    def __init__(self, main, mode: str, servers: int, distribution: str, seed: int):
+        self.main = main
+        self.mode = mode
+        self.rng = random.Random(seed)
+        self.distribution = distribution
+        self.server_ids = [f"server-{k}" for k in range(servers)]
+        self.weights = server_weights(servers)
+        self.matched: List[tuple] = []
+        self.ratings: Dict[str, int] = {}  # 匹配成功的玩家会移出评分缓存，分差按这里记录的评分计算
+
+        async def record_match(player1: Dict, player2: Dict, mode: str):
+            self.matched.append((player1, player2))
+
+        main.create_match = record_match
+
+    def reset(self):
+        main = self.main
+        main.shards[self.mode].queue.clear()
+        main.rating_cache.clear()
+        main.online_players.clear()
+        self.matched.clear()
+        self.ratings.clear()
+
+    def add_player(self, join_time: float):
+        main = self.main
+        player_id = uuid.UUID(int=self.rng.getrandbits(128), version=4).hex
+        server = self.rng.choices(self.server_ids, self.weights)[0]
+        rating = draw_rating(self.rng, self.distribution)
+        entry = {
+            "player_id": player_id,
+            "player_name": player_id[:8],
+            "server": server,
+            "pokemons": [],
+            "join_time": join_time
+        }
+        self.ratings[player_id] = rating
+        main.rating_cache.set(player_id, rating)
+        main.online_players[player_id] = server
+        main.shards[self.mode].queue.add(entry, rating)
+
+    def fill_unmatchable(self, size: int, join_time: float):
+        """评分间隔大于最大容忍度的队列，任何两名玩家都无法配对"""
+        main = self.main
+        spacing = max(main.tolerance_schedule.base, main.tolerance_schedule.cap or 0) + 1
+        for k in range(size):
+            player_id = f"idle-{k}"
+            server = self.rng.choices(self.server_ids, self.weights)[0]
+            entry = {
+                "player_id": player_id,
+                "player_name": player_id,
+                "server": server,
+                "pokemons": [],
+                "join_time": join_time
+            }
+            main.rating_cache.set(player_id, k * spacing)
+            main.online_players[player_id] = server
+            main.shards[self.mode].queue.add(entry, k * spacing)
+
+    def remove_players(self, player_ids: set):
+        main = self.main
+        queue = main.shards[self.mode].queue
+        for player_id in player_ids:
+            queue.remove(player_id)
+            main.rating_cache.discard(player_id)
+            main.online_players.pop(player_id, None)
+
+    def fill(self, size: int, join_time: float):
+        for _ in range(size):
+            self.add_player(join_time)
+
+    def rating_gap(self, player1: Dict, player2: Dict) -> int:
+        return abs(self.ratings[player1["player_id"]] - self.ratings[player2["player_id"]])
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+async def bench_passes(workload: Workload, size: int, repeats: int) -> Dict:
+    """每次重新填满队列，测量单次匹配的耗时、匹配率与分差"""
+    main = workload.main
+    wall_times, cpu_times, match_rates, gaps = [], [], [], []
+    for _ in range(repeats):
+        workload.reset()
+        workload.fill(size, time.time())
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        await main.check_matches(workload.mode)
+        wall_times.append(time.perf_counter() - wall_start)
+        cpu_times.append(time.process_time() - cpu_start)
+        match_rates.append(2 * len(workload.matched) / size if size else 0.0)
+        gaps.extend(workload.rating_gap(p1, p2) for p1, p2 in workload.matched)
+
+    # 满队列却配不出任何一对时，一次全量匹配的耗时就是遍历队列本身的开销；
+    # 随后逐个加入玩家，测量加入触发的增量匹配（只为新玩家查找对手）
+    idle_times, join_times = [], []
+    for _ in range(repeats):
+        workload.reset()
+        workload.fill_unmatchable(size, time.time())
+        cpu_start = time.process_time()
+        await main.check_matches(workload.mode)
+        idle_times.append(time.process_time() - cpu_start)
+        for _ in range(100):
+            workload.add_player(time.time())
+            player_id = next(reversed(main.shards[workload.mode].queue.entries))
+            start = time.perf_counter()
+            await main.check_matches(workload.mode, [player_id])
+            join_times.append(time.perf_counter() - start)
+
+    mean_wall = statistics.mean(wall_times)
+    return {
+        "passes_per_sec": 1 / mean_wall if mean_wall > 0 else float("inf"),
+        "cpu_ms_per_pass": statistics.mean(cpu_times) * 1000,
+        "idle_cpu_ms_per_pass": statistics.mean(idle_times) * 1000,
+        "join_ms_p50": percentile(join_times, 50) * 1000,
+        "join_ms_p99": percentile(join_times, 99) * 1000,
+        "match_rate": statistics.mean(match_rates),
+        "gap_mean": statistics.mean(gaps) if gaps else 0.0,
+        "gap_p50": percentile(gaps, 50),
+        "gap_p90": percentile(gaps, 90),
+        "gap_max": max(gaps) if gaps else 0
+    }
+
+
+async def simulate_waits(workload: Workload, size: int, ticks: int, tick_seconds: float) -> Dict:
+    """稳态仿真：每个时钟周期把队列补满到 size 并执行一次匹配，统计等待时间"""
+    main = workload.main
+    clock = VirtualClock()
+    real_time = main.time
+    main.time = clock
+    try:
+        workload.reset()
+        workload.fill(size, clock.now)
+        waits, timeouts = [], 0
+        for _ in range(ticks):
+            clock.now += tick_seconds
+            workload.matched.clear()
+            await main.check_matches(workload.mode)
+            for p1, p2 in workload.matched:
+                waits.append(clock.now - p1["join_time"])
+                waits.append(clock.now - p2["join_time"])
+                main.online_players.pop(p1["player_id"], None)
+                main.online_players.pop(p2["player_id"], None)
+
+            # 与 match_timeout_handler 一致，超时玩家移出队列
+            expired = {e["player_id"] for e in main.shards[workload.mode].queue
+                       if clock.now - e["join_time"] >= main.MATCH_TIMEOUT}
+            workload.remove_players(expired)
+            timeouts += len(expired)
+
+            workload.fill(size - len(main.shards[workload.mode].queue), clock.now)
+
+        # 仍在排队的玩家不计入等待分位数，单独报告其中最长的等待
+        queue = main.shards[workload.mode].queue
+        longest_waiting = max((clock.now - e["join_time"] for e in queue), default=0.0)
+    finally:
+        main.time = real_time
+
+    return {
+        "wait_p50": percentile(waits, 50),
+        "wait_p95": percentile(waits, 95),
+        "wait_p99": percentile(waits, 99),
+        "matched_players": len(waits),
+        "timeouts": timeouts,
+        "longest_waiting": longest_waiting
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="匹配器基准测试与仿真")
+    parser.add_argument("--sizes", default="10,100,1000,10000,50000", help="队列规模，逗号分隔")
+    parser.add_argument("--servers", type=int, default=8, help="子服数量")
+    parser.add_argument("--mode", default="singles", help="匹配模式")
+    parser.add_argument("--distribution", default="normal", choices=["normal", "skewed", "bimodal"])
+    parser.add_argument("--repeats", type=int, default=5, help="每个规模的匹配次数")
+    parser.add_argument("--ticks", type=int, default=120, help="等待时间仿真的周期数，0 表示跳过仿真")
+    parser.add_argument("--tick-seconds", type=float, default=3.0, help="仿真中每个周期代表的秒数")
+    parser.add_argument("--tolerance", type=int, default=None, help="覆盖配置中的 elo_max_diff")
+    parser.add_argument("--widen-per-minute", type=int, default=None, help="覆盖配置中的 elo_widen_per_minute")
+    parser.add_argument("--widen-cap", type=int, default=None, help="覆盖配置中的 elo_widen_cap")
+    parser.add_argument("--batch", action="store_true", help="启用批量配对")
+    parser.add_argument("--batch-budget-ms", type=float, default=None, help="覆盖配置中的 batch_budget_ms")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    server, work_dir = load_server_module()
+    if args.tolerance is not None:
+        server.MATCH_ELO_TOLERANCE = args.tolerance
+        server.tolerance_schedule.base = args.tolerance
+    if args.widen_per_minute is not None:
+        server.tolerance_schedule.per_minute = args.widen_per_minute
+    if args.widen_cap is not None:
+        server.tolerance_schedule.cap = args.widen_cap
+    if args.batch:
+        server.BATCH_PAIRING = True
+    if args.batch_budget_ms is not None:
+        server.BATCH_BUDGET_MS = args.batch_budget_ms
+
+    results = []
+    try:
+        for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+            workload = Workload(server, args.mode, args.servers, args.distribution, args.seed)
+            row = {"size": size}
+            row.update(asyncio.run(bench_passes(workload, size, args.repeats)))
+            if args.ticks > 0:
+                row.update(asyncio.run(simulate_waits(workload, size, args.ticks, args.tick_seconds)))
+            results.append(row)
+            if not args.json:
+                line = (f"size={size:>6} | {row['passes_per_sec']:>10.1f} passes/s | "
+                        f"cpu {row['cpu_ms_per_pass']:>9.3f} ms/pass | idle {row['idle_cpu_ms_per_pass']:>9.3f} ms/pass | "
+                        f"join p50/p99 {row['join_ms_p50']:.3f}/{row['join_ms_p99']:.3f} ms | "
+                        f"match {row['match_rate'] * 100:5.1f}% | "
+                        f"gap mean {row['gap_mean']:.1f} p50/p90/max {row['gap_p50']:.0f}/{row['gap_p90']:.0f}/{row['gap_max']:.0f}")
+                if args.ticks > 0:
+                    line += (f" | wait p50/p95/p99 {row['wait_p50']:.0f}/{row['wait_p95']:.0f}/{row['wait_p99']:.0f}s"
+                             f" | timeouts {row['timeouts']} | longest waiting {row['longest_waiting']:.0f}s")
+                print(line, flush=True)
+    finally:
+        os.chdir(BASE_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,305 @@
+"""
+评分与对战记录的流式导出/导入
+
+导出按主键分块读取（每块一个短事务），逐块格式化为 NDJSON 或 CSV，内存占用与表大小无关；
+导入按批 executemany，每批一个事务。服务端接口与命令行共用这里的实现。
+
+用法示例:
+    python bulk_io.py export battles --format csv --output battles.csv
+    python bulk_io.py import ratings ratings.ndjson --on-conflict ignore
+
+服务运行时请优先使用 /export、/import 接口：命令行直接写库，不会更新服务内存中的排行榜。
+"""
+import argparse
+import base64
+import csv
+import io
+import json
+import logging
+import sqlite3
+import sys
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("matchmaking")
+
+FORMATS = ("ndjson", "csv")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+CONFLICT_POLICIES = ("replace", "ignore")
+EXPORT_CHUNK = 5000  # 导出时每次读取的行数
+IMPORT_BATCH = 20000  # 导入时每个事务写入的行数
+PROGRESS_INTERVAL = 5.0  # 进度报告间隔（秒）
+
+
+class TableSpec:
+    """可导入导出的表：列按导出顺序排列，第一列为主键"""
+
+    def __init__(self, name: str, columns: Tuple[str, ...], blob_columns: Tuple[str, ...] = ()):
+        self.name = name
+        self.columns = columns
+        self.key = columns[0]
+        self.blob_columns = blob_columns  # 以 base64 文本导出
+
+    def select_chunk(self, conn: sqlite3.Connection, after: Optional[str], limit: int) -> List[tuple]:
+        # 按主键翻页而不是保持一个长游标，避免长读事务阻止 WAL 检查点
+        where = f"WHERE {self.key} > ?" if after is not None else ""
+        params = (after, limit) if after is not None else (limit,)
+        return [tuple(row) for row in conn.execute(f"""
+            SELECT {', '.join(self.columns)} FROM {self.name} {where}
+            ORDER BY {self.key} LIMIT ?
+        """, params)]
+
+    def insert_sql(self, on_conflict: str) -> str:
+        columns = ", ".join(self.columns)
+        placeholders = ", ".join("?" for _ in self.columns)
+        if on_conflict == "ignore":
+            return f"INSERT OR IGNORE INTO {self.name} ({columns}) VALUES ({placeholders})"
+        updates = ", ".join(f"{c} = excluded.{c}" for c in self.columns[1:])
+        return (f"INSERT INTO {self.name} ({columns}) VALUES ({placeholders}) "
+                f"ON CONFLICT({self.key}) DO UPDATE SET {updates}")
+
+
+TABLES = {
+    "ratings": TableSpec("ratings", ("player_id", "player_name", "rating", "wins", "losses",
+                                     "last_active", "last_server")),
+    # 尚未迁移的旧记录队伍仍内联在 team1/team2 中（已迁移的为 NULL），一并导出以免丢失
+    "battles": TableSpec("battles", ("battle_id", "timestamp", "player1", "player2", "mode", "winner",
+                                     "team1_hash", "team2_hash", "winner_elo_change", "loser_elo_change",
+                                     "team1", "team2")),
+    # 对战只保存队伍哈希，完整备份需要连同队伍一起导出
+    "teams": TableSpec("teams", ("team_hash", "encoding", "data"), blob_columns=("data",))
+}
+
+
+class Progress:
+    """统计已处理行数与速率，按间隔报告进度"""
+
+    def __init__(self, label: str, interval: float = PROGRESS_INTERVAL,
+                 report: Optional[Callable[[str], None]] = None):
+        self.label = label
+        self.interval = interval
+        self.report = report or logger.info
+        self.rows = 0
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self._last_report = self.started
+
+    def advance(self, rows: int):
+        self.rows += rows
+        now = time.monotonic()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report(f"{self.label}: {self.rows} 行，{self.rate():.0f} 行/秒")
+
+    def finish(self):
+        self.finished = time.monotonic()
+        self.report(f"{self.label} 完成: {self.rows} 行，用时 {self.elapsed():.1f} 秒，{self.rate():.0f} 行/秒")
+
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    def rate(self) -> float:
+        elapsed = self.elapsed()
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def summary(self) -> Dict:
+        return {
+            "operation": self.label,
+            "rows": self.rows,
+            "seconds": round(self.elapsed(), 3),
+            "rows_per_sec": round(self.rate(), 1),
+            "finished": self.finished is not None
+        }
+
+
+# ===================== 导出 =====================
+def _export_value(spec: TableSpec, column: str, value):
+    if value is not None and column in spec.blob_columns:
+        return base64.b64encode(value).decode("ascii")
+    return value
+
+
+def format_header(spec: TableSpec, fmt: str) -> str:
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerow(spec.columns)
+        return buffer.getvalue()
+    return ""
+
+
+def format_rows(spec: TableSpec, fmt: str, rows: List[tuple]) -> str:
+    rows = [tuple(_export_value(spec, c, v) for c, v in zip(spec.columns, row)) for row in rows]
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        return buffer.getvalue()
+    return "".join(json.dumps(dict(zip(spec.columns, row)), ensure_ascii=False) + "\n" for row in rows)
+
+
+def export_chunk(conn: sqlite3.Connection, spec: TableSpec, fmt: str, after: Optional[str],
+                 limit: int) -> Tuple[str, int, Optional[str]]:
+    """读取并格式化一块，返回 (文本, 行数, 本块最后的主键)"""
+    rows = spec.select_chunk(conn, after, limit)
+    if not rows:
+        return "", 0, after
+    return format_rows(spec, fmt, rows), len(rows), rows[-1][0]
+
+
+def iter_export(conn: sqlite3.Connection, spec: TableSpec, fmt: str, progress: Progress,
+                chunk: int = EXPORT_CHUNK) -> Iterator[str]:
+    """同步逐块导出（命令行使用）"""
+    yield format_header(spec, fmt)
+    after = None
+    while True:
+        text, count, after = export_chunk(conn, spec, fmt, after, chunk)
+        if not count:
+            break
+        progress.advance(count)
+        yield text
+    progress.finish()
+
+
+# ===================== 导入 =====================
+class RecordBatcher:
+    """把输入按行切分为记录并攒成批；CSV 中带换行的引号字段按引号配对合并为一条记录"""
+
+    def __init__(self, fmt: str, batch_size: int = IMPORT_BATCH):
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.header: Optional[List[str]] = None
+        self._batch: List[str] = []
+        self._partial = ""
+
+    def feed(self, line: str) -> Optional[List[str]]:
+        """送入一行（保留换行符），攒满一批时返回该批"""
+        if self.fmt == "csv":
+            record = self._partial + line
+            if record.count('"') % 2:
+                self._partial = record
+                return None
+            self._partial = ""
+            if self.header is None:
+                self.header = next(csv.reader([record]), [])
+                return None
+            line = record
+        if not line.strip():
+            return None
+        self._batch.append(line)
+        if len(self._batch) >= self.batch_size:
+            batch, self._batch = self._batch, []
+            return batch
+        return None
+
+    def finish(self) -> List[str]:
+        if self._partial.strip():
+            raise ValueError("CSV 在未闭合的引号字段中结束")
+        batch, self._batch = self._batch, []
+        return batch
+
+
+def parse_records(spec: TableSpec, fmt: str, header: Optional[List[str]], records: List[str]) -> List[tuple]:
+    """把一批记录解析为按 spec.columns 排列的参数元组；缺失的列为 NULL，多余的列忽略"""
+    if fmt == "csv":
+        if not header or spec.key not in header:
+            raise ValueError(f"CSV 表头缺少主键列 {spec.key}")
+        positions = [header.index(c) if c in header else None for c in spec.columns]
+        objects = []
+        for fields in csv.reader(records):
+            # CSV 无法区分空字符串与 NULL，空字段一律按 NULL 导入
+            objects.append({
+                column: (fields[pos] or None) if pos is not None and pos < len(fields) else None
+                for column, pos in zip(spec.columns, positions)
+            })
+    else:
+        objects = [json.loads(line) for line in records]
+
+    params = []
+    for obj in objects:
+        if obj.get(spec.key) is None:
+            raise ValueError(f"记录缺少主键 {spec.key}")
+        params.append(tuple(
+            base64.b64decode(obj[c]) if c in spec.blob_columns and obj.get(c) is not None else obj.get(c)
+            for c in spec.columns
+        ))
+    return params
+
+
+def import_batch(conn: sqlite3.Connection, spec: TableSpec, fmt: str, header: Optional[List[str]],
+                 records: List[str], on_conflict: str) -> List[tuple]:
+    """解析一批记录并在一个事务内写入，返回写入的参数元组"""
+    params = parse_records(spec, fmt, header, records)
+    try:
+        conn.execute("BEGIN")
+        conn.executemany(spec.insert_sql(on_conflict), params)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return params
+
+
+def import_lines(conn: sqlite3.Connection, spec: TableSpec, fmt: str, lines: Iterable[str],
+                 on_conflict: str, progress: Progress, batch_size: int = IMPORT_BATCH):
+    """同步逐批导入（命令行使用）"""
+    batcher = RecordBatcher(fmt, batch_size)
+    for line in lines:
+        batch = batcher.feed(line)
+        if batch:
+            progress.advance(len(import_batch(conn, spec, fmt, batcher.header, batch, on_conflict)))
+    batch = batcher.finish()
+    if batch:
+        progress.advance(len(import_batch(conn, spec, fmt, batcher.header, batch, on_conflict)))
+    progress.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="评分与对战记录的流式导出/导入")
+    parser.add_argument("--db", default="matchmaking.db", help="数据库文件")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = sub.add_parser("export", help="导出一张表")
+    export_parser.add_argument("table", choices=sorted(TABLES))
+    export_parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    export_parser.add_argument("--output", help="输出文件，默认标准输出")
+    export_parser.add_argument("--chunk", type=int, default=EXPORT_CHUNK, help="每次读取的行数")
+
+    import_parser = sub.add_parser("import", help="导入一张表")
+    import_parser.add_argument("table", choices=sorted(TABLES))
+    import_parser.add_argument("input", help="输入文件，- 表示标准输入")
+    import_parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    import_parser.add_argument("--on-conflict", choices=CONFLICT_POLICIES, default="replace",
+                               help="主键已存在时覆盖或跳过")
+    import_parser.add_argument("--batch", type=int, default=IMPORT_BATCH, help="每个事务写入的行数")
+    args = parser.parse_args()
+
+    from database import open_connection
+    conn = open_connection(args.db)
+    conn.isolation_level = None  # 事务由 import_batch 显式控制
+    spec = TABLES[args.table]
+    # 进度写到标准错误，导出到标准输出时不会混入数据
+    report = lambda message: print(message, file=sys.stderr, flush=True)
+
+    try:
+        if args.command == "export":
+            progress = Progress(f"导出 {spec.name}", report=report)
+            out = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+            try:
+                for text in iter_export(conn, spec, args.format, progress, args.chunk):
+                    out.write(text)
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+        else:
+            progress = Progress(f"导入 {spec.name}", report=report)
+            source = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8", newline="")
+            try:
+                import_lines(conn, spec, args.format, source, args.on_conflict, progress, args.batch)
+            finally:
+                if source is not sys.stdin:
+                    source.close()
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
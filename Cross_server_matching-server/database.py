@@ -0,0 +1,302 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger("matchmaking")
+
+# 连接级参数：WAL 下读写互不阻塞，NORMAL 只在检查点时 fsync
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",  # 约 16MB 页缓存
+    "PRAGMA mmap_size=268435456",  # 256MB 内存映射
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000"
+)
+STATEMENT_CACHE_SIZE = 256  # 每个连接缓存的预编译语句数
+
+
+def open_connection(db_file: str) -> sqlite3.Connection:
+    """打开一个长连接并应用调优参数"""
+    conn = sqlite3.connect(db_file, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class LatencyStats:
+    """按操作名统计最近的执行耗时"""
+
+    def __init__(self, maxlen: int = 500):
+        self.maxlen = maxlen
+        self._samples: Dict[str, Deque[float]] = {}
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()  # 数据库线程写入，事件循环读取
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self.maxlen)
+            samples.append(seconds)
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def summary(self) -> Dict[str, Dict]:
+        with self._lock:
+            snapshot = [(name, sorted(samples)) for name, samples in self._samples.items()]
+        result = {}
+        for name, ordered in snapshot:
+            result[name] = {
+                "count": self._counts[name],
+                "avg_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+                "p95_ms": round(ordered[int(0.95 * (len(ordered) - 1))] * 1000, 3),
+                "max_ms": round(ordered[-1] * 1000, 3)
+            }
+        return result
+
+
+class ConnectionPool:
+    """固定大小的长连接池，连接按需建立并一直保持打开"""
+
+    def __init__(self, db_file: str, size: int):
+        self.db_file = db_file
+        self.size = size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._all: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _take(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            # 按需建立连接，最多 size 个
+            if len(self._all) < self.size:
+                conn = open_connection(self.db_file)
+                self._all.append(conn)
+                return conn
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._take()
+        try:
+            yield conn
+        except BaseException:
+            # 归还前回滚未提交的事务，避免污染下一个使用者
+            conn.rollback()
+            raise
+        finally:
+            self._idle.put(conn)
+
+    @property
+    def open_connections(self) -> int:
+        return len(self._all)
+
+    @property
+    def idle_connections(self) -> int:
+        return self._idle.qsize()
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+        self._idle = queue.LifoQueue()
+
+
+class AsyncDatabase:
+    """SQLite 访问层：写操作在唯一的写线程上串行执行，读操作使用独立的读连接池"""
+
+    def __init__(self, db_file: str, readers: int = 2):
+        # 单线程执行器即单写线程，其内部队列就是请求队列
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="sqlite-reader")
+        self.write_pool = ConnectionPool(db_file, 1)
+        self.read_pool = ConnectionPool(db_file, readers)
+        self.latency = LatencyStats()  # 每种操作的执行耗时
+        self.checkout_wait = LatencyStats()  # 从提交到拿到连接的等待（含线程排队）
+        self.pending = 0  # 已提交尚未完成的操作数
+
+    @staticmethod
+    def _name_of(fn: Callable) -> str:
+        return fn.__qualname__.replace(".<locals>", "")
+
+    def _execute(self, pool: ConnectionPool, kind: str, submitted: float,
+                 fn: Callable[..., Any], args: tuple) -> Any:
+        with pool.connection() as conn:
+            start = time.perf_counter()
+            self.checkout_wait.record(kind, start - submitted)
+            try:
+                return fn(conn, *args)
+            finally:
+                self.latency.record(self._name_of(fn), time.perf_counter() - start)
+
+    async def _submit(self, executor: ThreadPoolExecutor, pool: ConnectionPool, kind: str,
+                      fn: Callable[..., Any], args: tuple) -> Any:
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(
+                executor, self._execute, pool, kind, time.perf_counter(), fn, args)
+        finally:
+            self.pending -= 1
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """在写线程上执行 fn(conn, *args) 并返回其结果"""
+        return await self._submit(self._writer, self.write_pool, "writer", fn, args)
+
+    async def read(self, fn: Callable[..., Any], *args) -> Any:
+        """在读线程上执行只读的 fn(conn, *args)，不与写操作排队"""
+        return await self._submit(self._readers, self.read_pool, "reader", fn, args)
+
+    def stats(self) -> Dict:
+        return {
+            "open_connections": self.write_pool.open_connections + self.read_pool.open_connections,
+            "idle_connections": self.write_pool.idle_connections + self.read_pool.idle_connections,
+            "pending": self.pending,
+            "checkout_wait": self.checkout_wait.summary(),
+            "queries": self.latency.summary()
+        }
+
+    def close(self):
+        """等待已提交的操作执行完毕后关闭数据库线程和连接"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        self.write_pool.close()
+        self.read_pool.close()
+
+
+class WriteBehindQueue:
+    """写后队列：把零散的写操作攒成一个事务提交，多次写入只付一次 fsync"""
+
+    def __init__(self, db: AsyncDatabase, interval_ms: float = 20, max_batch: int = 200, limit: int = 5000):
+        self.db = db
+        self.interval = interval_ms / 1000
+        self.max_batch = max_batch
+        self.limit = limit
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.records = 0
+        self.failed = 0
+        self.batch_latency = LatencyStats()
+
+    def start(self) -> asyncio.Task:
+        if self._task is None or self._task.done():
+            # 队列有界，写入跟不上时 write() 会等待而不是无限堆积
+            self._queue = asyncio.Queue(self.limit)
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def write(self, fn: Callable[..., Any], *args):
+        """排入 fn(conn, *args)，随下一批一起提交，不等待落盘"""
+        self.start()
+        await self._queue.put((fn, args, None))
+
+    async def write_now(self, fn: Callable[..., Any], *args) -> Any:
+        """排入 fn(conn, *args) 并立即提交当前批次，返回其结果；排在它之前的写入一定先生效"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((fn, args, future))
+        return await future
+
+    async def flush(self):
+        """等待此前排入的写入全部提交"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((None, (), future))
+        await future
+
+    async def _collect(self) -> List[Tuple[Optional[Callable], tuple, Optional[asyncio.Future]]]:
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.interval
+        # 攒够 max_batch 条、时间窗口结束或有人要求立即提交时结束本批
+        while len(batch) < self.max_batch and batch[-1][2] is None:
+            if self._queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self._queue.get_nowait())
+        return batch
+
+    @staticmethod
+    def _apply(conn: sqlite3.Connection, batch: list) -> List[Tuple[bool, Any]]:
+        """在一个事务内执行整批写入，单条失败只回滚到它自己的保存点"""
+        outcomes = []
+        conn.execute("BEGIN")
+        for fn, args, _ in batch:
+            if fn is None:
+                outcomes.append((True, None))
+                continue
+            conn.execute("SAVEPOINT write_item")
+            try:
+                outcomes.append((True, fn(conn, *args)))
+                conn.execute("RELEASE write_item")
+            except Exception as e:
+                conn.execute("ROLLBACK TO write_item")
+                conn.execute("RELEASE write_item")
+                outcomes.append((False, e))
+        conn.commit()
+        return outcomes
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            start = time.perf_counter()
+            try:
+                outcomes = await self.db.run(self._apply, batch)
+            except Exception as e:
+                logger.error(f"批量写入提交失败，丢弃 {len(batch)} 条写入: {e}", exc_info=True)
+                outcomes = [(False, e)] * len(batch)
+            self.batch_latency.record("commit", time.perf_counter() - start)
+            self.batches += 1
+
+            for (fn, _, future), (ok, value) in zip(batch, outcomes):
+                if fn is not None:
+                    self.records += 1
+                    if not ok:
+                        self.failed += 1
+                        if future is None:
+                            logger.error(f"写入失败 {AsyncDatabase._name_of(fn)}: {value}")
+                if future is not None and not future.done():
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+
+    async def close(self):
+        """提交队列中剩余的写入后停止"""
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def stats(self) -> Dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "batches": self.batches,
+            "records": self.records,
+            "failed": self.failed,
+            "avg_batch_size": round(self.records / self.batches, 2) if self.batches else 0.0,
+            "commit": self.batch_latency.summary().get("commit")
+        }
@@ -0,0 +1,35 @@
+import json
+from typing import Any, Iterable
+
+try:
+    import orjson
+except ImportError:  # 可选依赖，未安装时使用标准库
+    orjson = None
+
+_use_fast = orjson is not None
+
+
+def configure(fast_json: bool):
+    """配置是否使用 orjson 编码（仅在已安装时生效）"""
+    global _use_fast
+    _use_fast = fast_json and orjson is not None
+
+
+def encoder_name() -> str:
+    return "orjson" if _use_fast else "json"
+
+
+def encode(message: Any) -> str:
+    """把消息编码为 JSON 文本帧"""
+    if _use_fast:
+        return orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+
+def with_encoded_list(head: str, key: str, parts: Iterable[str]) -> str:
+    """在已编码的对象 head 末尾追加一个由已编码元素组成的数组字段
+
+    消息头和各接收方共享的元素都只编码一次，按接收方拼接时不再重复序列化。
+    """
+    separator = "," if head != "{}" else ""
+    return f"{head[:-1]}{separator}{encode(key)}:[{','.join(parts)}]}}"
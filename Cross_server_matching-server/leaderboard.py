@@ -0,0 +1,229 @@
+import random
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+MAX_LEVEL = 24  # 足够容纳千万级玩家
+DEFAULT_RATING = 1000
+
+
+class _Last:
+    """比任何键都大的哨兵"""
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return False
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key: Any, level: int):
+        self.key = key
+        self.next: List["_Node"] = [None] * level
+        self.width: List[int] = [1] * level  # 沿该层链接前进会跨过的元素数
+
+
+_NIL = _Node(_Last(), 0)
+
+
+def _random_level() -> int:
+    # 随机位的末尾零个数服从 p=1/2 的几何分布
+    bits = random.getrandbits(MAX_LEVEL - 1)
+    return (bits & -bits).bit_length() if bits else MAX_LEVEL
+
+
+class IndexableSkipList:
+    """带跨度的跳表：插入、删除、按键求排名、按排名取键均为 O(log n)"""
+
+    def __init__(self):
+        self.head = _Node(None, MAX_LEVEL)
+        self.head.next = [_NIL] * MAX_LEVEL
+        self.size = 0
+
+    def build(self, keys: List[Any]):
+        """由已排序的键一次性建表，O(n)"""
+        self.__init__()
+        last = [self.head] * MAX_LEVEL
+        last_pos = [0] * MAX_LEVEL
+        for pos, key in enumerate(keys, 1):
+            node = _Node(key, _random_level())
+            for level in range(len(node.next)):
+                prev = last[level]
+                prev.next[level] = node
+                prev.width[level] = pos - last_pos[level]
+                last[level] = node
+                last_pos[level] = pos
+        end = len(keys) + 1
+        for level in range(MAX_LEVEL):
+            last[level].next[level] = _NIL
+            last[level].width[level] = end - last_pos[level]
+        self.size = len(keys)
+
+    def insert(self, key: Any):
+        chain = [None] * MAX_LEVEL
+        steps_at_level = [0] * MAX_LEVEL
+        node = self.head
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        new_node = _Node(key, _random_level())
+        steps = 0
+        for level in range(len(new_node.next)):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(len(new_node.next), MAX_LEVEL):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key: Any):
+        chain = [None] * MAX_LEVEL
+        node = self.head
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        target = chain[0].next[0]
+        if target is _NIL or target.key != key:
+            raise KeyError(key)
+
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), MAX_LEVEL):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, key: Any) -> int:
+        """键的 0 起始排名"""
+        node = self.head
+        pos = 0
+        for level in reversed(range(MAX_LEVEL)):
+            while node.next[level].key < key:
+                pos += node.width[level]
+                node = node.next[level]
+        target = node.next[0]
+        if target is _NIL or target.key != key:
+            raise KeyError(key)
+        return pos
+
+    def slice(self, start: int, count: int) -> List[Any]:
+        """从 0 起始排名 start 开始取 count 个键"""
+        if start < 0 or start >= self.size or count <= 0:
+            return []
+        node = self.head
+        remaining = start + 1
+        for level in reversed(range(MAX_LEVEL)):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        keys = []
+        while node is not _NIL and len(keys) < count:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class Leaderboard:
+    """内存排行榜，排序与原 SQL 一致：评分降序、胜率降序、胜场降序"""
+
+    def __init__(self):
+        self.players: Dict[str, Dict] = {}
+        self._keys: Dict[str, Tuple] = {}
+        self._list = IndexableSkipList()
+
+    @staticmethod
+    def sort_key(player: Dict) -> Tuple:
+        games = player["wins"] + player["losses"]
+        win_rate = player["wins"] * 1.0 / games if games > 0 else 0
+        # 最后以 player_id 兜底，保证同分玩家的顺序稳定
+        return -player["rating"], -win_rate, -player["wins"], player["player_id"]
+
+    @staticmethod
+    def _record(player_id: str, player_name: Optional[str], rating: Optional[int], wins: Optional[int],
+                losses: Optional[int], last_server: Optional[str]) -> Dict:
+        return {
+            "player_id": player_id,
+            "player_name": player_name,
+            "rating": DEFAULT_RATING if rating is None else rating,
+            "wins": wins or 0,
+            "losses": losses or 0,
+            "last_server": last_server
+        }
+
+    def load(self, rows: Iterable[Dict]):
+        """启动时载入全部评分"""
+        self.players = {row["player_id"]: self._record(**row) for row in rows}
+        self._keys = {player_id: self.sort_key(p) for player_id, p in self.players.items()}
+        self._list.build(sorted(self._keys.values()))
+
+    def upsert(self, player_id: str, player_name: Optional[str], rating: Optional[int], wins: Optional[int],
+               losses: Optional[int], last_server: Optional[str]):
+        """写入（或更新）一名玩家的完整记录"""
+        player = self._record(player_id, player_name, rating, wins, losses, last_server)
+        key = self.sort_key(player)
+        old_key = self._keys.get(player_id)
+        if old_key != key:
+            if old_key is not None:
+                self._list.remove(old_key)
+            self._list.insert(key)
+            self._keys[player_id] = key
+        self.players[player_id] = player
+
+    def touch(self, player_id: str, player_name: Optional[str], last_server: Optional[str]):
+        """更新名称与所在子服，新玩家以初始分加入"""
+        player = self.players.get(player_id)
+        if player is None:
+            self.upsert(player_id, player_name, None, 0, 0, last_server)
+        else:
+            player["player_name"] = player_name
+            player["last_server"] = last_server
+
+    def rank_of(self, player_id: str) -> Optional[int]:
+        """1 起始的全局排名，玩家不存在时返回 None"""
+        key = self._keys.get(player_id)
+        return None if key is None else self._list.rank(key) + 1
+
+    def _rows(self, start: int, count: int) -> List[Dict]:
+        return [
+            dict(self.players[key[-1]], global_rank=start + offset + 1)
+            for offset, key in enumerate(self._list.slice(start, count))
+        ]
+
+    def page(self, page: int, per_page: int) -> List[Dict]:
+        return self._rows((page - 1) * per_page, per_page)
+
+    def around(self, player_id: str, radius: int) -> List[Dict]:
+        """玩家及其前后各 radius 名"""
+        rank = self.rank_of(player_id)
+        if rank is None:
+            return []
+        start = max(0, rank - 1 - radius)
+        return self._rows(start, rank - 1 - start + radius + 1)
+
+    def search(self, term: str) -> List[Dict]:
+        """按 ID 或名称子串筛选（全量扫描，仅用于搜索）"""
+        term = term.lower()
+        matched = [
+            player_id for player_id, p in self.players.items()
+            if term in player_id.lower() or term in (p["player_name"] or "").lower()
+        ]
+        matched.sort(key=self._keys.__getitem__)
+        return [dict(self.players[player_id], global_rank=self.rank_of(player_id)) for player_id in matched]
+
+    def __contains__(self, player_id: str) -> bool:
+        return player_id in self.players
+
+    def __len__(self) -> int:
+        return len(self._list)
@@ -1,5 +1,6 @@
 import socket
 import os
+import codecs
 import json
 import uuid
 import asyncio
@@ -7,18 +8,34 @@ import sqlite3
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import uvicorn
+from collections import deque
 from contextlib import contextmanager
 from datetime import datetime, timedelta
-from math import pow
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, Body, Header, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
 from pydantic import BaseModel, ValidationError
-from typing import List, Dict, Optional
+from typing import AsyncIterator, List, Dict, Optional
 import time
 
+from archive import (ARCHIVE_CHUNK, SEASON_NAME, SeasonArchives, archive_battles_chunk, archive_path,
+                     copy_ratings_chunk, detach_archive, fetch_season_ranking, finish_rollover, prepare_archive)
 from battle_system import BattleInstance
+from bulk_io import (CONFLICT_POLICIES, FORMATS, MEDIA_TYPES, TABLES, Progress, RecordBatcher,
+                     export_chunk, format_header, import_batch)
+from database import AsyncDatabase, WriteBehindQueue
+import frames
+from timer_wheel import TimerWheel
+from usage_stats import UsageCounter
+from leaderboard import Leaderboard
+from match_history import create_history_indexes
+import timeseries
+from snapshot import encode_state, read_snapshot, with_encoded_list, write_snapshot
+from settlement import SettlementGuard, create_settlement_table, settle_battle
+from team_store import add_team_hash_columns, create_team_table, load_team, migrate_battle_teams_chunk, store_team
+from outbound import OVERFLOW_POLICIES, OutboundChannel
+from matchmaking import MatchmakingShard, MatchQueue, RatingCache, ToleranceSchedule, find_pairs, find_pairs_batch
 
 app = FastAPI()
 player_names: Dict[str, str] = {}
@@ -33,6 +50,20 @@ CONFIG_FILE = "config.json"
 # 默认配置
 SERVER_TOKENS = {}
 MATCH_ELO_TOLERANCE = 300
+MATCH_ELO_WIDEN_PER_MINUTE = 50  # 每等待一分钟放宽的评分容忍度
+MATCH_ELO_WIDEN_CAP = 800  # 容忍度放宽上限
+BATCH_PAIRING = False  # 是否启用全局批量配对（高峰期使用）
+BATCH_BUDGET_MS = 50  # 每次批量配对的计算预算
+DB_READ_CONNECTIONS = 2  # 只读连接池大小
+WRITE_BATCH_MS = 20  # 写后队列攒批的时间窗口
+WRITE_BATCH_SIZE = 200  # 单个事务最多包含的写入数
+WRITE_QUEUE_LIMIT = 5000  # 写后队列上限
+USAGE_FLUSH_INTERVAL = 60  # 宝可梦使用次数写回间隔（秒）
+TEAM_COMPRESSION = True  # 队伍数据是否压缩存储
+VACUUM_AFTER_MIGRATION = False  # 队伍迁移完成后是否 VACUUM（期间写线程被占用，所有写入都要等待）
+SNAPSHOT_FILE = "state_snapshot.bin"  # 运行状态快照文件（zlib 压缩的 JSON）
+SNAPSHOT_INTERVAL = 15  # 快照间隔（秒）
+SNAPSHOT_MAX_AGE = 600  # 超过该时长（秒）的快照不再恢复
 API_KEY = "cobblemonranked"
 MATCH_TIMEOUT = 1800
 IS_TEST_VERSION = False
@@ -47,6 +78,28 @@ if os.path.exists(CONFIG_FILE):
         config_data = json.load(f)
         SERVER_TOKENS = config_data.get("server_tokens", {})
         MATCH_ELO_TOLERANCE = config_data.get("elo_max_diff", 300)
+        MATCH_ELO_WIDEN_PER_MINUTE = config_data.get("elo_widen_per_minute", 50)
+        MATCH_ELO_WIDEN_CAP = config_data.get("elo_widen_cap", 800)
+        BATCH_PAIRING = config_data.get("batch_pairing", False)
+        BATCH_BUDGET_MS = config_data.get("batch_budget_ms", 50)
+        DB_READ_CONNECTIONS = config_data.get("db_read_connections", 2)
+        WRITE_BATCH_MS = config_data.get("write_batch_ms", 20)
+        WRITE_BATCH_SIZE = config_data.get("write_batch_size", 200)
+        WRITE_QUEUE_LIMIT = config_data.get("write_queue_limit", 5000)
+        USAGE_FLUSH_INTERVAL = config_data.get("usage_flush_interval", 60)
+        TEAM_COMPRESSION = config_data.get("team_compression", True)
+        VACUUM_AFTER_MIGRATION = config_data.get("vacuum_after_migration", False)
+        SNAPSHOT_FILE = config_data.get("snapshot_file", "state_snapshot.bin")
+        SNAPSHOT_INTERVAL = config_data.get("snapshot_interval", 15)
+        SNAPSHOT_MAX_AGE = config_data.get("snapshot_max_age", 600)
+        EXPORT_CHUNK_ROWS = config_data.get("export_chunk_rows", 5000)
+        IMPORT_BATCH_ROWS = config_data.get("import_batch_rows", 20000)
+        ARCHIVE_DIR = config_data.get("archive_dir", "archives")
+        ARCHIVE_CHUNK_ROWS = config_data.get("archive_chunk_rows", ARCHIVE_CHUNK)
+        FAST_JSON = config_data.get("fast_json", True)
+        OUTBOUND_QUEUE_LIMIT = config_data.get("outbound_queue_limit", 1000)
+        OUTBOUND_OVERFLOW = config_data.get("outbound_overflow", "coalesce")
+        OUTBOUND_SEND_TIMEOUT = config_data.get("outbound_send_timeout", 10)
         API_KEY = config_data.get("api_key", "admin123")
         MATCH_TIMEOUT = config_data.get("match_timeout", 1800)
         IS_TEST_VERSION = config_data.get("is_test_version", False)
@@ -55,6 +108,28 @@ if os.path.exists(CONFIG_FILE):
 else:
     SERVER_TOKENS = {"server-a": "abc123", "server-b": "def456"}
     MATCH_ELO_TOLERANCE = 300
+    MATCH_ELO_WIDEN_PER_MINUTE = 50
+    MATCH_ELO_WIDEN_CAP = 800
+    BATCH_PAIRING = False
+    BATCH_BUDGET_MS = 50
+    DB_READ_CONNECTIONS = 2
+    WRITE_BATCH_MS = 20
+    WRITE_BATCH_SIZE = 200
+    WRITE_QUEUE_LIMIT = 5000
+    USAGE_FLUSH_INTERVAL = 60
+    TEAM_COMPRESSION = True
+    VACUUM_AFTER_MIGRATION = False
+    SNAPSHOT_FILE = "state_snapshot.bin"
+    SNAPSHOT_INTERVAL = 15
+    SNAPSHOT_MAX_AGE = 600
+    EXPORT_CHUNK_ROWS = 5000
+    IMPORT_BATCH_ROWS = 20000
+    ARCHIVE_DIR = "archives"
+    ARCHIVE_CHUNK_ROWS = ARCHIVE_CHUNK
+    FAST_JSON = True
+    OUTBOUND_QUEUE_LIMIT = 1000
+    OUTBOUND_OVERFLOW = "coalesce"
+    OUTBOUND_SEND_TIMEOUT = 10
     API_KEY = "cobblemonranked"
     MATCH_TIMEOUT = 1800
     IS_TEST_VERSION = False
@@ -141,9 +216,16 @@ def init_db():
             mode TEXT,
             winner TEXT,
             team1 TEXT,
-            team2 TEXT
+            team2 TEXT,
+            team1_hash TEXT,
+            team2_hash TEXT,
+            winner_elo_change INTEGER,
+            loser_elo_change INTEGER
         )""")
 
+        # 队伍按内容哈希去重存储，battles 只保存哈希（team1/team2 仅为旧数据保留）
+        create_team_table(cursor)
+
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS server_status (
             server_id TEXT PRIMARY KEY,
@@ -172,60 +254,99 @@ def init_db():
 
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_ratings_rating ON ratings(rating)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_battles_timestamp ON battles(timestamp)")
+        create_history_indexes(cursor)
+        create_settlement_table(cursor)
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_status_history_timestamp ON status_history(timestamp)")
+
+        # 状态指标的分钟/小时/天汇总表
+        timeseries.create_rollup_tables(cursor)
         conn.commit()
 
 init_db()
 
 
-def record_pokemon_usage(player1: Dict, player2: Dict):
-    """记录宝可梦使用次数"""
+def ensure_team_columns():
+    """旧库补上队伍哈希列；内联队伍数据由 migrate_team_storage 在启动后迁移"""
     with get_db_connection() as conn:
-        cursor = conn.cursor()
+        add_team_hash_columns(conn)
 
-        # 创建临时表存储本次使用的宝可梦
-        cursor.execute("""
-            CREATE TEMP TABLE IF NOT EXISTS temp_pokemon_usage (
-                pokemon_name TEXT PRIMARY KEY
-            )
-        """)
+ensure_team_columns()
+db = AsyncDatabase(DB_FILE, readers=DB_READ_CONNECTIONS)  # 运行时的数据库读写都经由数据库线程和长连接
+# 对战、使用率与评分写入合并提交
+write_behind = WriteBehindQueue(db, WRITE_BATCH_MS, WRITE_BATCH_SIZE, WRITE_QUEUE_LIMIT)
+usage_counter = UsageCounter()  # 宝可梦使用次数以内存计数为准
+leaderboard = Leaderboard()  # 排行榜查询只读内存，评分变化时同步更新
+settlement_guard = SettlementGuard()  # 同一对战只结算一次
 
-        # 清空临时表
-        cursor.execute("DELETE FROM temp_pokemon_usage")
+LEADERBOARD_COLUMNS = "player_id, player_name, rating, wins, losses, last_server"
 
-        # 记录玩家1的宝可梦
-        for pokemon in player1["pokemons"]:
-            pokemon_name = pokemon.get("name", "未知宝可梦").strip().lower()
-            cursor.execute("""
-                INSERT OR IGNORE INTO temp_pokemon_usage (pokemon_name)
-                VALUES (?)
-            """, (pokemon_name,))
 
-        # 记录玩家2的宝可梦
-        for pokemon in player2["pokemons"]:
-            pokemon_name = pokemon.get("name", "未知宝可梦").strip().lower()
-            cursor.execute("""
-                INSERT OR IGNORE INTO temp_pokemon_usage (pokemon_name)
-                VALUES (?)
-            """, (pokemon_name,))
+def load_leaderboard():
+    """启动时把全部评分载入内存排行榜"""
+    with get_db_connection() as conn:
+        rows = conn.execute(f"SELECT {LEADERBOARD_COLUMNS} FROM ratings").fetchall()
+    leaderboard.load(dict(row) for row in rows)
 
-        # 更新主表
-        cursor.execute("""
-            INSERT OR REPLACE INTO pokemon_usage (pokemon_name, usage_count)
-            SELECT 
-                t.pokemon_name,
-                COALESCE(pu.usage_count, 0) + 1
-            FROM temp_pokemon_usage t
-            LEFT JOIN pokemon_usage pu ON t.pokemon_name = pu.pokemon_name
-        """)
+load_leaderboard()
 
-        conn.commit()
+
+def load_pokemon_usage():
+    """启动时把累计使用次数载入内存计数"""
+    with get_db_connection() as conn:
+        rows = conn.execute("SELECT pokemon_name, usage_count FROM pokemon_usage").fetchall()
+    usage_counter.load((row["pokemon_name"], row["usage_count"]) for row in rows)
+
+load_pokemon_usage()
+
+season_archives = SeasonArchives(ARCHIVE_DIR)  # 已归档赛季，历史查询在线上库查不全时继续读取
+season_archives.load()
+
+
+def record_pokemon_usage(player1: Dict, player2: Dict):
+    """记录宝可梦使用次数（只更新内存计数，由 flush_pokemon_usage 定期写回）"""
+    usage_counter.record_battle(player1, player2)
+
+
+async def flush_pokemon_usage():
+    """把内存中的使用次数增量一次性写回数据库"""
+    pending = usage_counter.take_pending()
+    if not pending:
+        return
+
+    def write(conn: sqlite3.Connection):
+        conn.executemany("""
+            INSERT INTO pokemon_usage (pokemon_name, usage_count)
+            VALUES (?, ?)
+            ON CONFLICT(pokemon_name) DO UPDATE SET usage_count = usage_count + excluded.usage_count
+        """, pending.items())
+
+    try:
+        await write_behind.write_now(write)
+    except Exception as e:
+        usage_counter.restore_pending(pending)
+        logger.error(f"写回宝可梦使用次数失败: {e}")
+
+
+async def periodic_usage_flush():
+    """定期写回宝可梦使用次数"""
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        await flush_pokemon_usage()
 
 # ===================== 状态存储 =====================
-matchmaking_queue: Dict[str, List[Dict]] = {"singles": [], "doubles": []}
+# 每个模式一个独立分片（模式 -> 最少宝可梦数量）
+# 对战引擎目前只实现了单打规则（每方一只在场、单打行动顺序），双打在引擎支持前不开放
+shards: Dict[str, MatchmakingShard] = {
+    "singles": MatchmakingShard("singles", min_team_size=1),
+    "doubles": MatchmakingShard("doubles", min_team_size=2, enabled=False)
+}
+matchmaking_queue: Dict[str, MatchQueue] = {mode: shard.queue for mode, shard in shards.items()}
 online_players: Dict[str, str] = {}
+pending_joins: Dict[str, Dict] = {}  # 正在写库、尚未放入队列的加入请求：player_id -> 队列条目
 active_battles: Dict[str, BattleInstance] = {}
-pending_matches: Dict[str, asyncio.Task] = {}
+match_timers = TimerWheel(tick=1.0)  # 匹配超时定时器：player_id -> 模式
+rating_cache = RatingCache()  # 匹配器唯一的评分来源
+tolerance_schedule = ToleranceSchedule(MATCH_ELO_TOLERANCE, MATCH_ELO_WIDEN_PER_MINUTE, MATCH_ELO_WIDEN_CAP)
 
 # ===================== 模型 =====================
 class JoinRequest(BaseModel):
@@ -252,52 +373,110 @@ class ChatMessage(BaseModel):
     channel: str = "battle"
 
 # ===================== WebSocket 连接管理 =====================
+frames.configure(FAST_JSON)
+if FAST_JSON and frames.encoder_name() != "orjson":
+    logger.warning("已启用 fast_json，但未安装 orjson，消息编码改用标准库 json（pip install orjson）")
+logger.info(f"消息编码器: {frames.encoder_name()}")
+if OUTBOUND_OVERFLOW not in OVERFLOW_POLICIES:
+    logger.warning(f"未知的发送队列溢出策略 {OUTBOUND_OVERFLOW}，改用 coalesce")
+    OUTBOUND_OVERFLOW = "coalesce"
+
 class ConnectionManager:
     def __init__(self):
         self.active_connections: Dict[str, WebSocket] = {}
         self.last_ping: Dict[str, float] = {}
-        self.server_players: Dict[str, List[str]] = {}  # 服务器到玩家列表的映射
+        self.server_players: Dict[str, set] = {}  # 服务器到玩家集合的映射
+        self.player_server: Dict[str, str] = {}  # 玩家到所在服务器的反向映射
+        self.channels: Dict[str, OutboundChannel] = {}  # 每个连接独立的发送队列与写协程
+        self.frames_encoded = 0
+        self.frames_sent = 0
 
     async def connect(self, websocket: WebSocket, server_id: str):
         await websocket.accept()
         self.active_connections[server_id] = websocket
+        channel = OutboundChannel(server_id, websocket.send_text, OUTBOUND_QUEUE_LIMIT, OUTBOUND_OVERFLOW,
+                                  OUTBOUND_SEND_TIMEOUT, self._channel_failed)
+        channel.start()
+        self.channels[server_id] = channel
         self.last_ping[server_id] = time.time()
-        self.server_players[server_id] = []
+        self.server_players.setdefault(server_id, set())  # 保留快照恢复的玩家映射
         logger.info(f"子服 {server_id} 已连接")
 
     def disconnect(self, server_id: str):
+        channel = self.channels.pop(server_id, None)
+        if channel is not None:
+            channel.close()
         if server_id in self.active_connections:
             del self.active_connections[server_id]
         if server_id in self.last_ping:
             del self.last_ping[server_id]
         if server_id in self.server_players:
-            del self.server_players[server_id]
+            for player_id in self.server_players.pop(server_id):
+                self.player_server.pop(player_id, None)
         logger.info(f"子服 {server_id} 断开连接")
 
     # 更新玩家列表的方法
     def update_player_server(self, player_id: str, server_id: str):
         # 先从旧服务器移除玩家
-        for srv, players in list(self.server_players.items()):
-            if player_id in players:
-                players.remove(player_id)
+        self.remove_player(player_id)
 
         # 添加到新服务器
-        if server_id not in self.server_players:
-            self.server_players[server_id] = []
-        if player_id not in self.server_players[server_id]:
-            self.server_players[server_id].append(player_id)
+        self.server_players.setdefault(server_id, set()).add(player_id)
+        self.player_server[player_id] = server_id
 
-    async def send_message(self, message: Dict, server_id: str):
-        if server_id in self.active_connections:
-            try:
-                await self.active_connections[server_id].send_text(json.dumps(message))
-            except Exception as e:
-                logger.error(f"向 {server_id} 发送消息失败: {e}")
-                self.disconnect(server_id)
+    def remove_player(self, player_id: str):
+        server_id = self.player_server.pop(player_id, None)
+        if server_id in self.server_players:
+            self.server_players[server_id].discard(player_id)
+
+    def encode(self, message: Dict) -> str:
+        """编码一条消息；同一帧可直接发给多个子服"""
+        self.frames_encoded += 1
+        return frames.encode(message)
+
+    def _channel_failed(self, server_id: str, reason: str):
+        logger.error(f"向 {server_id} 发送消息失败，断开连接: {reason}")
+        websocket = self.active_connections.get(server_id)
+        self.disconnect(server_id)
+        if websocket is not None:
+            asyncio.create_task(self._close(websocket))
+
+    @staticmethod
+    async def _close(websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+
+    def queue_frame(self, frame: str, server_id: str, key: Optional[str] = None):
+        """把已编码的帧放入该连接的发送队列，不等待发送完成；key 相同的帧可被合并"""
+        channel = self.channels.get(server_id)
+        if channel is not None and channel.put(frame, key):
+            self.frames_sent += 1
+
+    async def send_frame(self, frame: str, server_id: str, key: Optional[str] = None):
+        self.queue_frame(frame, server_id, key)
+
+    async def send_message(self, message: Dict, server_id: str, key: Optional[str] = None):
+        await self.send_frame(self.encode(message), server_id, key)
+
+    async def send_to(self, message: Dict, server_ids):
+        """同一消息发给多个子服，只编码一次"""
+        frame = self.encode(message)
+        for server_id in server_ids:
+            await self.send_frame(frame, server_id)
 
     async def broadcast(self, message: Dict):
-        for server_id in list(self.active_connections.keys()):
-            await self.send_message(message, server_id)
+        await self.send_to(message, list(self.active_connections.keys()))
+
+    def stats(self) -> Dict:
+        return {
+            "encoder": frames.encoder_name(),
+            "frames_encoded": self.frames_encoded,
+            "frames_sent": self.frames_sent,
+            "overflow_policy": OUTBOUND_OVERFLOW,
+            "servers": {server_id: channel.stats() for server_id, channel in self.channels.items()}
+        }
 
 manager = ConnectionManager()
 
@@ -313,11 +492,12 @@ async def websocket_connect(websocket: WebSocket, server_id: str, token: str = Q
         await websocket.close(code=114)
         return
 
-    expected_version = "1.2.0"
+    # 1.3.0 起对战事件改为按回合合并的 battle_events 帧，旧版模组无法解析，必须升级
+    expected_version = "1.3.0"
 
     if version != expected_version:
-        logger.warning(f"拒绝连接: 非法版本号来自 {server_id} ({websocket.client.host})")
-        await websocket.close(code=1008)
+        logger.warning(f"拒绝连接: 版本号 {version} 不匹配（需要 {expected_version}）来自 {server_id} ({websocket.client.host})")
+        await websocket.close(code=1008, reason=f"模组版本 {version} 不受支持，请升级到 {expected_version}")
         return
 
     if IS_TEST_VERSION:
@@ -388,16 +568,19 @@ async def join_queue(payload: JoinRequest):
             status_code=410
         )
 
-    if payload.mode not in matchmaking_queue:
+    if payload.mode not in shards:
         return JSONResponse({"error": "无效的匹配模式"}, status_code=400)
 
-    for mode, queue in matchmaking_queue.items():
-        if any(e["player_id"] == payload.player_id for e in queue):
-            return JSONResponse({"error": "你已在匹配队列中"}, status_code=400)
+    if not shards[payload.mode].enabled:
+        return JSONResponse({"error": f"{payload.mode} 模式暂不支持，请使用单打模式"}, status_code=400)
 
-    if payload.player_id in pending_matches:
-        pending_matches[payload.player_id].cancel()
-        del pending_matches[payload.player_id]
+    if len(payload.pokemons) < shards[payload.mode].min_team_size:
+        return JSONResponse({"error": "队伍宝可梦数量不足"}, status_code=400)
+
+    if payload.player_id in pending_joins or any(payload.player_id in queue for queue in matchmaking_queue.values()):
+        return JSONResponse({"error": "你已在匹配队列中"}, status_code=400)
+
+    match_timers.cancel(payload.player_id)
 
     entry = {
         "player_id": payload.player_id,
@@ -407,15 +590,14 @@ async def join_queue(payload: JoinRequest):
         "join_time": time.time()
     }
 
+    # 写库前先占位：等待期间的重复加入会被拒绝，离开队列会撤销占位
+    pending_joins[payload.player_id] = entry
     player_names[payload.player_id] = payload.player_name or payload.player_id
     online_players[payload.player_id] = payload.server
 
-    matchmaking_queue[payload.mode].append(entry)
-    online_players[payload.player_id] = payload.server
-
-    with get_db_connection() as conn:
+    def touch_player(conn: sqlite3.Connection) -> Optional[sqlite3.Row]:
         cursor = conn.cursor()
-        cursor.execute("SELECT player_id FROM ratings WHERE player_id = ?", (payload.player_id,))
+        cursor.execute("SELECT player_id, rating FROM ratings WHERE player_id = ?", (payload.player_id,))
         row = cursor.fetchone()
 
         player_name = payload.player_name or payload.player_id
@@ -433,21 +615,39 @@ async def join_queue(payload: JoinRequest):
                 """, (payload.player_id, player_name, payload.server, beijing_time().isoformat()))
 
         conn.commit()
+        return row
 
-    pending_matches[payload.player_id] = asyncio.create_task(
-        match_timeout_handler(payload.player_id, payload.mode)
-    )
+    try:
+        row = await db.run(touch_player)
+    except BaseException:
+        if pending_joins.get(payload.player_id) is entry:
+            del pending_joins[payload.player_id]
+        raise
+
+    # 等待数据库期间玩家可能已离开队列，此时占位已被撤销，不再入队
+    if pending_joins.get(payload.player_id) is not entry:
+        logger.info(f"玩家 {payload.player_id} 在加入过程中离开了匹配队列，取消加入")
+        return JSONResponse({"error": "加入匹配已取消"}, status_code=400)
+    del pending_joins[payload.player_id]
+
+    leaderboard.touch(payload.player_id, payload.player_name or payload.player_id, payload.server)
+
+    # 加入队列时载入评分缓存
+    rating_cache.set(payload.player_id, row["rating"] if row else None)
+    matchmaking_queue[payload.mode].add(entry, rating_cache.get(payload.player_id))
+
+    match_timers.schedule(payload.player_id, MATCH_TIMEOUT, payload.mode)
     # 更新服务器玩家映射
     manager.update_player_server(payload.player_id, payload.server)
 
     logger.info(
         f"玩家 {payload.player_name}({payload.player_id}) 加入 {payload.mode} 队列 | 来自子服: {payload.server} | 当前队列长度: {len(matchmaking_queue[payload.mode])}")
-    asyncio.create_task(check_matches())
+    shards[payload.mode].notify(payload.player_id)
     return {"status": "ok", "message": "已加入匹配队列"}
 
 
-async def broadcast_battle_log(battle: BattleInstance, event_dict: dict):
-    """广播战斗事件给相关服务器（确保每个服务器只收到一次）"""
+def broadcast_battle_events(battle: BattleInstance, events: List[dict]):
+    """把一批战斗事件编码为一帧，按序号顺序发给相关服务器（每个服务器一次）"""
     # 创建服务器集合（自动去重）
     servers_to_notify = set()
 
@@ -456,30 +656,31 @@ async def broadcast_battle_log(battle: BattleInstance, event_dict: dict):
         server_id = online_players.get(player_id)
         if server_id:
             servers_to_notify.add(server_id)
+    if not servers_to_notify:
+        return
 
-    event_dict["battle_id"] = battle.battle_id
-
-    # 向每个相关服务器发送一次通知
+    frame = manager.encode({
+        "type": "battle_events",
+        "battle_id": battle.battle_id,
+        "events": events
+    })
     for server_id in servers_to_notify:
-        try:
-            await manager.send_message({
-                "type": "battle_event",
-                "data": event_dict
-            }, server_id)
-        except Exception as e:
-            logger.error(f"向服务器 {server_id} 发送战斗事件失败: {e}")
+        manager.queue_frame(frame, server_id)
 
-async def match_timeout_handler(player_id: str, mode: str):
-    await asyncio.sleep(MATCH_TIMEOUT)
+def forget_rating(player_id: str):
+    """玩家已不在任何队列中时移除其缓存评分"""
+    if not any(player_id in shard.queue for shard in shards.values()):
+        rating_cache.discard(player_id)
 
-    if player_id in pending_matches:
-        queue = matchmaking_queue[mode]
-        queue[:] = [e for e in queue if e["player_id"] != player_id]
+def expire_queue_entries(expired: List[tuple]):
+    """时间轮回调：批量移除匹配超时的玩家"""
+    for player_id, mode in expired:
+        matchmaking_queue[mode].remove(player_id)
+        forget_rating(player_id)
 
         if player_id in online_players:
             del online_players[player_id]
 
-        del pending_matches[player_id]
         logger.info(f"玩家 {player_id} 匹配超时，已从队列中移除")
 
 @app.post("/leave-queue")
@@ -487,24 +688,19 @@ async def leave_queue(player_id: str = Body(..., embed=True)):
     if not player_id:
         return JSONResponse({"error": "缺少 player_id"}, status_code=400)
 
-    if player_id in pending_matches:
-        pending_matches[player_id].cancel()
-        del pending_matches[player_id]
+    match_timers.cancel(player_id)
 
-    removed = False
+    # 加入请求仍在写库时只需撤销占位，join_queue 恢复后不会再入队
+    removed = pending_joins.pop(player_id, None) is not None
     for mode, queue in matchmaking_queue.items():
-        before = len(queue)
-        queue[:] = [e for e in queue if e["player_id"] != player_id]
-        after = len(queue)
-        if before != after:
+        if queue.remove(player_id) is not None:
             # 从服务器玩家映射中移除
-            for server_id, players in list(manager.server_players.items()):
-                if player_id in players:
-                    players.remove(player_id)
+            manager.remove_player(player_id)
 
             logger.info(
                 f"玩家 {player_id} 离开匹配队列 | 当前 singles: {len(matchmaking_queue['singles'])}, doubles: {len(matchmaking_queue['doubles'])}")
             removed = True
+    rating_cache.discard(player_id)
 
     if player_id in online_players:
         del online_players[player_id]
@@ -514,6 +710,170 @@ async def leave_queue(player_id: str = Body(..., embed=True)):
 
     return {"status": "ok", "message": "离开匹配队列"}
 
+@app.get("/matchmaking-stats")
+async def get_matchmaking_stats(
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None)
+):
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+
+    return {
+        "modes": {
+            mode: {
+                "queue_length": len(shard.queue),
+                "time_to_match": shard.wait_stats.percentiles(),
+                "pairing": shard.pairing_stats.summary(),
+                "passes": {
+                    "total": shard.loop.passes if shard.loop else 0,
+                    "full": shard.loop.full_passes if shard.loop else 0,
+                    "widening": shard.loop.widening_passes if shard.loop else 0
+                }
+            }
+            for mode, shard in shards.items()
+        },
+        "batch_pairing": BATCH_PAIRING,
+        "settlement": settlement_guard.summary(),
+        "fanout": manager.stats(),
+        "timers": {
+            "pending": len(match_timers),
+            "expired_total": match_timers.expired_total
+        }
+    }
+
+@app.get("/database-stats")
+async def get_database_stats(
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None)
+):
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+
+    stats = db.stats()
+    stats["write_behind"] = write_behind.stats()
+    stats["bulk_operations"] = [progress.summary() for progress in bulk_operations]
+    return stats
+
+# ===================== 批量导出/导入 =====================
+bulk_operations = deque(maxlen=10)  # 最近的导出/导入任务及其进度
+
+def get_table_spec(table: str, fmt: str):
+    spec = TABLES.get(table)
+    if spec is None:
+        raise HTTPException(status_code=404, detail="未知的数据表")
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=400, detail="不支持的格式")
+    return spec
+
+@app.get("/export/{table}")
+async def export_table(
+        table: str,
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None),
+        format: str = Query("ndjson"),
+        chunk: Optional[int] = Query(None, ge=100, le=50000)
+):
+    """以 NDJSON 或 CSV 流式导出整张表，逐块在读连接上读取和格式化"""
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+    spec = get_table_spec(table, format)
+    chunk = chunk or EXPORT_CHUNK_ROWS
+
+    progress = Progress(f"导出 {table}")
+    bulk_operations.append(progress)
+
+    async def body():
+        yield format_header(spec, format)
+        after = None
+        while True:
+            text, count, after = await db.read(export_chunk, spec, format, after, chunk)
+            if not count:
+                break
+            progress.advance(count)
+            yield text
+        progress.finish()
+
+    filename = f"{table}-{beijing_time().strftime('%Y%m%d-%H%M%S')}.{format}"
+    return StreamingResponse(body(), media_type=MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+async def request_lines(request: Request) -> AsyncIterator[str]:
+    """把请求体按行切分（保留换行符），不整体读入内存"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    async for data in request.stream():
+        buffer += decoder.decode(data)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line + "\n"
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+async def apply_import_batch(spec, fmt: str, header: Optional[List[str]], records: List[str],
+                             on_conflict: str, progress: Progress):
+    def write(conn: sqlite3.Connection):
+        params = import_batch(conn, spec, fmt, header, records, on_conflict)
+        if spec.name != "ratings":
+            return len(params), []
+        # 读回实际落库的评分，用于同步内存排行榜
+        rows = conn.execute(f"""
+            SELECT {LEADERBOARD_COLUMNS} FROM ratings
+            WHERE player_id IN (SELECT value FROM json_each(?))
+        """, (json.dumps([p[0] for p in params]),)).fetchall()
+        return len(params), [dict(row) for row in rows]
+
+    count, players = await db.run(write)
+    for i, player in enumerate(players, 1):
+        player_id = player["player_id"]
+        leaderboard.upsert(**player)
+        # 排队中的玩家按导入的评分重新放入评分索引，并为其重新查找对手
+        for shard in shards.values():
+            if player_id in shard.queue:
+                rating_cache.set(player_id, player["rating"])
+                shard.queue.update_rating(player_id, rating_cache.get(player_id))
+                shard.notify(player_id)
+        if i % 1000 == 0:
+            await asyncio.sleep(0)
+    progress.advance(count)
+
+@app.post("/import/{table}")
+async def import_table(
+        table: str,
+        request: Request,
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None),
+        format: str = Query("ndjson"),
+        on_conflict: str = Query("replace")
+):
+    """流式导入 NDJSON 或 CSV，每批一个事务；出错时已提交的批次保留"""
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+    spec = get_table_spec(table, format)
+    if on_conflict not in CONFLICT_POLICIES:
+        raise HTTPException(status_code=400, detail="不支持的冲突处理方式")
+
+    progress = Progress(f"导入 {table}")
+    bulk_operations.append(progress)
+    batcher = RecordBatcher(format, IMPORT_BATCH_ROWS)
+    try:
+        async for line in request_lines(request):
+            batch = batcher.feed(line)
+            if batch:
+                await apply_import_batch(spec, format, batcher.header, batch, on_conflict, progress)
+        batch = batcher.finish()
+        if batch:
+            await apply_import_batch(spec, format, batcher.header, batch, on_conflict, progress)
+    except (ValueError, sqlite3.Error) as e:
+        progress.finish()
+        raise HTTPException(status_code=400, detail=f"导入失败（已导入 {progress.rows} 行）: {e}")
+    progress.finish()
+    return progress.summary()
+
 # ===================== 管理接口 =====================
 # os.makedirs("templates", exist_ok=True)
 # templates = Jinja2Templates(directory="templates")
@@ -526,176 +886,325 @@ async def leave_queue(player_id: str = Body(..., embed=True)):
 #     return templates.TemplateResponse("index.html", {"request": request})
 
 
-# # 获取宝可梦使用统计
-# @app.get("/pokemon-usage")
-# async def get_pokemon_usage(
-#         x_api_key: Optional[str] = Header(None),
-#         api_key: Optional[str] = Query(None),
-#         limit: int = Query(10, ge=1, le=20)
-# ):
-#     provided_key = x_api_key or api_key
-#     if provided_key != API_KEY:
-#         raise HTTPException(status_code=403, detail="无效 API 密钥")
-
-#     with get_db_connection() as conn:
-#         cursor = conn.cursor()
-
-#         # 获取总使用次数
-#         cursor.execute("SELECT SUM(usage_count) as total_count FROM pokemon_usage")
-#         total_row = cursor.fetchone()
-#         total_count = total_row["total_count"] or 1  # 避免除以零
-
-#         # 获取使用统计
-#         cursor.execute("""
-#             SELECT pokemon_name, usage_count 
-#             FROM pokemon_usage 
-#             ORDER BY usage_count DESC 
-#             LIMIT ?
-#         """, (limit,))
-
-#         results = cursor.fetchall()
-#         return [
-#             {
-#                 "name": row["pokemon_name"],
-#                 "count": row["usage_count"],
-#                 "usage_rate": (row["usage_count"] / total_count) * 100  # 计算使用率百分比
-#             }
-#             for row in results
-#         ]
-
-# @app.get("/trend-data")
-# async def get_trend_data(
-#         x_api_key: Optional[str] = Header(None),
-#         api_key: Optional[str] = Query(None)
-# ):
-#     provided_key = x_api_key or api_key
-#     if provided_key != API_KEY:
-#         raise HTTPException(status_code=403, detail="无效 API 密钥")
-
-#     realtime_status = {
-#         "online_servers": len(manager.active_connections),
-#         "queue_singles": len(matchmaking_queue["singles"]),
-#         "queue_doubles": len(matchmaking_queue["doubles"]),
-#         "active_battles": len(active_battles),
-#         "online_players": (
-#                 len(matchmaking_queue["singles"]) +
-#                 len(matchmaking_queue["doubles"]) * 2 +
-#                 (len(active_battles) * 2)
-#         )
-#     }
-
-#     end_time = beijing_time().replace(minute=0, second=0, microsecond=0)  # 取当前整点
-#     start_time = end_time - timedelta(hours=24)  # 24小时前整点
-
-#     with get_db_connection() as conn:
-#         cursor = conn.cursor()
-
-#         # 生成完整的24小时时间点
-#         full_hours = [(end_time - timedelta(hours=i)).strftime("%H:%M") for i in range(24, -1, -1)]
-
-#         cursor.execute("""
-#             SELECT 
-#                 strftime('%H:00', timestamp) AS hour_minute,
-#                 AVG(online_servers) AS avg_servers,
-#                 AVG(active_battles) AS avg_battles,
-#                 AVG(online_players) AS avg_players
-#             FROM status_history
-#             WHERE timestamp >= ? AND timestamp <= ?
-#             GROUP BY strftime('%H', timestamp)  -- 按小时分组
-#             ORDER BY timestamp
-#         """, (start_time.isoformat(), end_time.isoformat()))
-
-#         # 创建数据映射
-#         data_map = {row["hour_minute"]: row for row in cursor.fetchall()}
-
-#         # 填充完整24小时数据
-#         servers_data = []
-#         battles_data = []
-#         players_data = []
-
-#         for hour in full_hours:
-#             if hour in data_map:
-#                 row = data_map[hour]
-#                 servers_data.append(row["avg_servers"])
-#                 battles_data.append(row["avg_battles"])
-#                 players_data.append(row["avg_players"])
-#             else:
-#                 # 无数据时使用0填充
-#                 servers_data.append(0)
-#                 battles_data.append(0)
-#                 players_data.append(0)
-
-#         return {
-#             "realtime": realtime_status,
-#             "hours": full_hours,  # 使用生成的完整时间点
-#             "servers": servers_data,
-#             "battles": battles_data,
-#             "players": players_data
-#         }
-
-# @app.get("/ranking")
-# async def get_ranking(
-#         x_api_key: Optional[str] = Header(None),
-#         api_key: Optional[str] = Query(None),
-#         page: int = Query(1, ge=1),
-#         per_page: int = Query(10, ge=5, le=100),
-#         search: Optional[str] = Query(None)
-# ):
-#     provided_key = x_api_key or api_key
-#     if provided_key != API_KEY:
-#         raise HTTPException(status_code=403, detail="无效 API 密钥")
-
-#     with get_db_connection() as conn:
-#         cursor = conn.cursor()
-
-#         base_query = """
-#             WITH FullRanking AS (
-#                 SELECT 
-#                     player_id, 
-#                     player_name, 
-#                     rating, 
-#                     wins, 
-#                     losses, 
-#                     last_server,
-#                     ROW_NUMBER() OVER (
-#                         ORDER BY 
-#                             rating DESC,
-#                             CASE WHEN wins + losses > 0 THEN wins * 1.0 / (wins + losses) ELSE 0 END DESC,
-#                             wins DESC
-#                     ) AS global_rank 
-#                 FROM ratings
-#             )
-#             SELECT * FROM FullRanking
-#             WHERE 1=1
-#         """
-
-#         params = []
-#         if search:
-#             base_query += " AND (player_id LIKE ? OR player_name LIKE ?)"
-#             search_term = f"%{search}%"
-#             params.extend([search_term, search_term])
-
-#         count_query = f"SELECT COUNT(*) as total FROM ({base_query})"
-#         cursor.execute(count_query, params)
-#         total_count = cursor.fetchone()["total"]
-
-#         total_pages = (total_count + per_page - 1) // per_page
-#         offset = (page - 1) * per_page
-
-#         data_query = base_query + " ORDER BY global_rank LIMIT ? OFFSET ?"
-#         params.extend([per_page, offset])
-#         rows = cursor.execute(data_query, params).fetchall()
-
-#         return {
-#             "players": [dict(row) for row in rows],
-#             "pagination": {
-#                 "page": page,
-#                 "per_page": per_page,
-#                 "total_pages": total_pages,
-#                 "total_players": total_count,
-#                 "current_page_size": len(rows)
-#             }
-#         }
+# 获取宝可梦使用统计（直接读取内存计数）
+@app.get("/pokemon-usage")
+async def get_pokemon_usage(
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None),
+        limit: int = Query(10, ge=1, le=20)
+):
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+
+    return usage_counter.top(limit)
+
+# 获取对战双方队伍（由 teams 表还原 JSON）
+@app.get("/battles/{battle_id}/teams")
+async def get_battle_teams(
+        battle_id: str,
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None)
+):
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+
+    def read(conn: sqlite3.Connection):
+        row = conn.execute("""
+            SELECT player1, player2, team1, team2, team1_hash, team2_hash
+            FROM battles WHERE battle_id = ?
+        """, (battle_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "battle_id": battle_id,
+            "player1": row["player1"],
+            "player2": row["player2"],
+            # 尚未迁移的旧记录直接使用内联数据
+            "team1": row["team1"] if row["team1"] is not None else load_team(conn, row["team1_hash"]),
+            "team2": row["team2"] if row["team2"] is not None else load_team(conn, row["team2_hash"])
+        }
+
+    teams = await db.read(read)
+    if teams is None:
+        teams = await asyncio.get_running_loop().run_in_executor(None, season_archives.first, read)
+    if teams is None:
+        raise HTTPException(status_code=404, detail="对战不存在")
+    for key in ("team1", "team2"):
+        try:
+            teams[key] = json.loads(teams[key]) if teams[key] is not None else None
+        except ValueError:
+            pass  # 无法解析的旧数据原样返回
+    return teams
+
+# 玩家对战记录（覆盖索引 + 键集分页）
+@app.get("/players/{player_id}/battles")
+async def get_player_battles(
+        player_id: str,
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None),
+        limit: int = Query(20, ge=1, le=100),
+        before_timestamp: Optional[str] = Query(None),
+        before_battle_id: Optional[str] = Query(None),
+        include_elo: bool = Query(False)
+):
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+    if (before_timestamp is None) != (before_battle_id is None):
+        raise HTTPException(status_code=400, detail="before_timestamp 与 before_battle_id 需同时提供")
+
+    before = (before_timestamp, before_battle_id) if before_timestamp is not None else None
+    rows = await db.read(season_archives.player_battles, player_id, limit, before)
+
+    battles = []
+    for row in rows:
+        battle = {
+            "battle_id": row["battle_id"],
+            "timestamp": row["timestamp"],
+            "mode": row["mode"],
+            "opponent": row["player2"] if row["player1"] == player_id else row["player1"],
+            "winner": row["winner"],
+            "result": None if row["winner"] is None else ("win" if row["winner"] == player_id else "loss")
+        }
+        if include_elo:
+            if row["winner"] is None:
+                battle["elo_change"] = None
+            else:
+                battle["elo_change"] = row["winner_elo_change"] if row["winner"] == player_id else row["loser_elo_change"]
+        battles.append(battle)
+
+    # 满页时返回下一页的键
+    next_page = None
+    if len(rows) == limit:
+        next_page = {"before_timestamp": rows[-1]["timestamp"], "before_battle_id": rows[-1]["battle_id"]}
+
+    return {"player_id": player_id, "battles": battles, "next": next_page}
+
+# 状态趋势（读取汇总表，按时间范围自动选择粒度）
+@app.get("/trend-data")
+async def get_trend_data(
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None),
+        hours: int = Query(24, ge=1, le=24 * 730),
+        tier: Optional[str] = Query(None)
+):
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+    if tier is not None and tier not in timeseries.TIERS_BY_NAME:
+        raise HTTPException(status_code=400, detail="无效的汇总粒度")
+
+    realtime_status = collect_status()
+
+    now = beijing_time()
+    end_time = now.replace(minute=0, second=0, microsecond=0)  # 取当前整点
+    start_time = end_time - timedelta(hours=hours)
+    selected = (timeseries.TIERS_BY_NAME[tier] if tier is not None
+                else timeseries.choose_tier(start_time, end_time, now))
+
+    def read(conn: sqlite3.Connection):
+        return timeseries.query(conn, selected, start_time, end_time)
+
+    buckets, samples, series = await db.read(read)
+
+    if selected.name == "day":
+        label_format = "%Y-%m-%d"
+    elif hours <= 24:
+        label_format = "%H:%M"
+    else:
+        label_format = "%m-%d %H:%M"
+
+    return {
+        "realtime": realtime_status,
+        "tier": selected.name,
+        "hours": [bucket.strftime(label_format) for bucket in buckets],
+        "servers": series["online_servers"]["avg"],
+        "battles": series["active_battles"]["avg"],
+        "players": series["online_players"]["avg"],
+        "samples": samples,
+        "series": series
+    }
+
+# 排行榜（内存跳表，排名与分页均为 O(log n)）
+@app.get("/ranking")
+async def get_ranking(
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None),
+        page: int = Query(1, ge=1),
+        per_page: int = Query(10, ge=5, le=100),
+        search: Optional[str] = Query(None)
+):
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+
+    if search:
+        matched = leaderboard.search(search)
+        total_count = len(matched)
+        offset = (page - 1) * per_page
+        rows = matched[offset:offset + per_page]
+    else:
+        total_count = len(leaderboard)
+        rows = leaderboard.page(page, per_page)
+
+    total_pages = (total_count + per_page - 1) // per_page
+
+    return {
+        "players": rows,
+        "pagination": {
+            "page": page,
+            "per_page": per_page,
+            "total_pages": total_pages,
+            "total_players": total_count,
+            "current_page_size": len(rows)
+        }
+    }
+
+# 玩家排名及前后的玩家
+@app.get("/ranking/player/{player_id}")
+async def get_player_ranking(
+        player_id: str,
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None),
+        radius: int = Query(5, ge=0, le=50)
+):
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+
+    rank = leaderboard.rank_of(player_id)
+    if rank is None:
+        raise HTTPException(status_code=404, detail="玩家不存在")
+
+    return {
+        "player_id": player_id,
+        "global_rank": rank,
+        "total_players": len(leaderboard),
+        "neighbors": leaderboard.around(player_id, radius)
+    }
+
+# ===================== 赛季归档 =====================
+season_lock = asyncio.Lock()  # 同一时间只允许一次赛季切换
+
+def requeue_with_ratings(ratings: Dict[str, int]):
+    """评分整体重置后，排队中的玩家按新评分重新放入评分索引，并触发一次全量匹配"""
+    for shard in shards.values():
+        for entry in shard.queue:
+            player_id = entry["player_id"]
+            rating_cache.set(player_id, ratings.get(player_id))
+            shard.queue.update_rating(player_id, rating_cache.get(player_id))
+        shard.notify()
+
+async def rollover_season(season: str, carry_over: float, vacuum: bool) -> Dict:
+    """把截止当前的对战与最终评分移入赛季归档文件，然后重置线上评分"""
+    path = archive_path(ARCHIVE_DIR, season)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    progress = Progress(f"归档赛季 {season}")
+    bulk_operations.append(progress)
+
+    await write_behind.flush()  # 排队中的对战记录先落库
+    cutoff = await db.run(prepare_archive, path, season, beijing_time().isoformat())
+    try:
+        ratings_copied_at = beijing_time().isoformat()
+        after = None
+        while True:
+            count, after = await db.run(copy_ratings_chunk, after, ARCHIVE_CHUNK_ROWS)
+            if not count:
+                break
+            progress.advance(count)
+
+        # 每块单独提交，期间其他写入可以穿插执行；进行中的对战每块重新取一次
+        while True:
+            count = await db.run(archive_battles_chunk, cutoff, ARCHIVE_CHUNK_ROWS, list(active_battles))
+            if not count:
+                break
+            progress.advance(count)
+
+        await write_behind.flush()
+        summary = await db.run(finish_rollover, season, ratings_copied_at, beijing_time().isoformat(),
+                               carry_over, rating_cache.default_rating, LEADERBOARD_COLUMNS)
+        # 线上评分已重置，紧接着（中间不让出事件循环）重建内存排行榜与评分缓存
+        ratings = summary.pop("ratings")
+        leaderboard.load(ratings)
+        rating_cache.clear()
+        requeue_with_ratings({row["player_id"]: row["rating"] for row in ratings})
+    finally:
+        await db.run(detach_archive)
+    progress.finish()
+    season_archives.add(path)
+
+    if vacuum:
+        await db.run(lambda conn: conn.execute("VACUUM"))
+    await db.run(lambda conn: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)"))
+
+    logger.info(f"赛季 {season} 已归档: {summary['battles']} 场对战，{summary['players']} 名玩家")
+    summary.update(cutoff=cutoff, archive=path, seconds=round(progress.elapsed(), 3))
+    return summary
+
+@app.post("/season/rollover")
+async def season_rollover(
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None),
+        season: str = Query(...),
+        carry_over: float = Query(0.0, ge=0.0, le=1.0),
+        vacuum: bool = Query(False)
+):
+    """赛季切换；carry_over 为新赛季保留的评分比例（相对初始分），0 表示清空评分"""
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+    if not SEASON_NAME.match(season):
+        raise HTTPException(status_code=400, detail="赛季名称无效")
+    if season_lock.locked():
+        raise HTTPException(status_code=409, detail="赛季归档正在进行")
+
+    async with season_lock:
+        try:
+            return await rollover_season(season, carry_over, vacuum)
+        except ValueError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/seasons")
+async def get_seasons(
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None)
+):
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+    return {"seasons": season_archives.seasons()}
+
+@app.get("/seasons/{season}/ranking")
+async def get_season_ranking(
+        season: str,
+        x_api_key: Optional[str] = Header(None),
+        api_key: Optional[str] = Query(None),
+        page: int = Query(1, ge=1),
+        per_page: int = Query(10, ge=5, le=100)
+):
+    """已归档赛季的最终排名"""
+    provided_key = x_api_key or api_key
+    if provided_key != API_KEY:
+        raise HTTPException(status_code=403, detail="无效 API 密钥")
+    archive = season_archives.get(season)
+    if archive is None:
+        raise HTTPException(status_code=404, detail="赛季不存在")
+
+    total_count, rows = await asyncio.get_running_loop().run_in_executor(
+        None, archive.query, fetch_season_ranking, page, per_page)
+    return {
+        "season": season,
+        "players": rows,
+        "pagination": {
+            "page": page,
+            "per_page": per_page,
+            "total_pages": (total_count + per_page - 1) // per_page,
+            "total_players": total_count,
+            "current_page_size": len(rows)
+        }
+    }
 
 # ===================== 历史数据记录任务 =====================
 peak_status = {
@@ -741,7 +1250,7 @@ async def record_status_history():
 
             current_status_cache = status
 
-            with get_db_connection() as conn:
+            def write(conn: sqlite3.Connection):
                 cursor = conn.cursor()
                 cursor.execute("""
                     INSERT INTO status_history 
@@ -755,14 +1264,15 @@ async def record_status_history():
                     status["active_battles"],
                     status["online_players"]
                 ))
-                conn.commit()
 
-                cursor.execute("""
-                    DELETE FROM status_history 
-                    WHERE timestamp < datetime('now', '-7 days')
-                """)
+                # 每小时按各粒度的保留时长清理一次
+                cursor.execute("DELETE FROM status_history WHERE timestamp < ?",
+                               ((next_hour - timedelta(days=7)).isoformat(),))
+                timeseries.prune(conn, next_hour)
                 conn.commit()
 
+            await db.run(write)
+
             logger.info(f"记录状态峰值: {status}")
 
             # 重置峰值状态
@@ -777,24 +1287,38 @@ async def record_status_history():
         except Exception as e:
             logger.error(f"记录状态历史失败: {e}")
 
-def update_peak_status():
-    global peak_status, current_status_cache
-
-    current_online_players = (
-            len(matchmaking_queue["singles"]) +
-            len(matchmaking_queue["doubles"]) * 2 +
-            (len(active_battles) * 2)
-    )
-
-    current_status = {
-        "timestamp": beijing_time().isoformat(),
+def collect_status() -> Dict:
+    """当前各项状态指标"""
+    return {
         "online_servers": len(manager.active_connections),
         "queue_singles": len(matchmaking_queue["singles"]),
         "queue_doubles": len(matchmaking_queue["doubles"]),
         "active_battles": len(active_battles),
-        "online_players": current_online_players
+        "online_players": (
+                len(matchmaking_queue["singles"]) +
+                len(matchmaking_queue["doubles"]) * 2 +
+                (len(active_battles) * 2)
+        )
     }
 
+async def sample_status_rollups():
+    """每分钟采样一次状态指标，增量累加到各粒度汇总表"""
+    while True:
+        now = beijing_time()
+        next_minute = (now + timedelta(minutes=1)).replace(second=0, microsecond=0)
+        await asyncio.sleep((next_minute - now).total_seconds())
+
+        try:
+            await write_behind.write(timeseries.record_sample, next_minute, collect_status())
+        except Exception as e:
+            logger.error(f"记录状态采样失败: {e}")
+
+def update_peak_status():
+    global peak_status, current_status_cache
+
+    current_status = collect_status()
+    current_status["timestamp"] = beijing_time().isoformat()
+
     current_status_cache = current_status
 
     for key in peak_status:
@@ -804,52 +1328,15 @@ def update_peak_status():
     asyncio.get_event_loop().call_later(60, update_peak_status)
 
 # ===================== Elo & 战斗记录 =====================
-def calculate_elo(winner_id: str, loser_id: str, cursor: sqlite3.Cursor, k: int = 32):
-    rating1 = get_rating(winner_id, cursor)
-    rating2 = get_rating(loser_id, cursor)
-
-    expected1 = 1 / (1 + pow(10, (rating2 - rating1) / 400))
-    expected2 = 1 / (1 + pow(10, (rating1 - rating2) / 400))
-
-    new_rating1 = round(rating1 + k * (1 - expected1))
-    new_rating2 = round(rating2 + k * (0 - expected2))
-
-    winner_name = player_names.get(winner_id, winner_id)
-    cursor.execute("""
-        UPDATE ratings 
-        SET rating = ?, wins = wins + 1, last_active = ?, player_name = ?
-        WHERE player_id = ?
-    """, (new_rating1, beijing_time().isoformat(), winner_name, winner_id))
-
-    loser_name = player_names.get(loser_id, loser_id)
-    cursor.execute("""
-        UPDATE ratings 
-        SET rating = ?, losses = losses + 1, last_active = ?, player_name = ?
-        WHERE player_id = ?
-    """, (new_rating2, beijing_time().isoformat(), loser_name, loser_id))
-
-def get_rating(player_id: str, cursor: sqlite3.Cursor) -> int:
-    cursor.execute("SELECT rating FROM ratings WHERE player_id = ?", (player_id,))
-    row = cursor.fetchone()
-
-    if row:
-        return row["rating"]
-    else:
-        cursor.execute("""
-            INSERT INTO ratings (player_id, rating, last_active)
-            VALUES (?, ?, ?)
-        """, (player_id, 1000, beijing_time().isoformat()))
-        return 1000
-
-def record_battle(player1: Dict, player2: Dict, mode: str) -> str:
+async def record_battle(player1: Dict, player2: Dict, mode: str) -> str:
     battle_id = str(uuid.uuid4())
     timestamp = beijing_time().isoformat()
 
-    with get_db_connection() as conn:
+    def write(conn: sqlite3.Connection):
         cursor = conn.cursor()
         cursor.execute("""
             INSERT INTO battles (
-                battle_id, timestamp, player1, player2, mode, team1, team2
+                battle_id, timestamp, player1, player2, mode, team1_hash, team2_hash
             ) VALUES (?, ?, ?, ?, ?, ?, ?)
         """, (
             battle_id,
@@ -857,164 +1344,167 @@ def record_battle(player1: Dict, player2: Dict, mode: str) -> str:
             player1["player_id"],
             player2["player_id"],
             mode,
-            json.dumps(player1["pokemons"]),
-            json.dumps(player2["pokemons"])
+            store_team(conn, player1["pokemons"], TEAM_COMPRESSION),
+            store_team(conn, player2["pokemons"], TEAM_COMPRESSION)
         ))
-        conn.commit()
 
+    await write_behind.write(write)
     return battle_id
 
 # ===================== 匹配逻辑 =====================
-async def check_matches():
-    """检查并创建匹配"""
-    # 单打匹配逻辑
-    singles_queue = matchmaking_queue["singles"]
-
-    # 清理重复玩家
-    seen = set()
-    singles_queue[:] = [p for p in singles_queue if not (p["player_id"] in seen or seen.add(p["player_id"]))]
-
-    if len(singles_queue) >= 2:
-        # 按评分排序
-        singles_queue.sort(key=lambda p: get_rating_safe(p["player_id"]))
-
-        # 尝试匹配相近评分的玩家
-        i = 0
-        while i < len(singles_queue) - 1:
-            p1 = singles_queue[i]
-            r1 = get_rating_safe(p1["player_id"])
-
-            # 查找最佳匹配（跳过相同玩家）
-            best_match = None
-            best_diff = float('inf')
-
-            for j in range(i + 1, len(singles_queue)):
-                p2 = singles_queue[j]
-
-                # 防止自匹配
-                if p1["player_id"] == p2["player_id"]:
-                    continue
-
-                if p1["server"] == p2["server"]:
-                    continue  # 跳过同一服务器的玩家
-
-                r2 = get_rating_safe(p2["player_id"])
-                rating_diff = abs(r1 - r2)
-
-                # 检查是否在容忍范围内
-                if rating_diff <= MATCH_ELO_TOLERANCE:
-                    # 检查玩家是否在线
-                    if (p1["player_id"] in online_players and
-                            p2["player_id"] in online_players):
-
-                        # 记录最佳匹配
-                        if rating_diff < best_diff:
-                            best_match = (j, p2)
-                            best_diff = rating_diff
-
-            if best_match:
-                j, p2 = best_match
-                # 从队列中移除玩家
-                player2 = singles_queue.pop(j)
-                player1 = singles_queue.pop(i)
-
-                # 取消匹配超时任务
-                for player_id in [player1["player_id"], player2["player_id"]]:
-                    if player_id in pending_matches:
-                        pending_matches[player_id].cancel()
-                        del pending_matches[player_id]
-
-                # 记录对战
-                battle_id = record_battle(player1, player2, "singles")
-
-                logger.info(
-                    f"[匹配成功] {player1['player_name']}（{player1['player_id']}） vs {player2['player_name']}（{player2['player_id']}） | 模式: singles | 对战ID: {battle_id}")
-                logger.info(
-                    f"[队列状态] singles: {len(matchmaking_queue['singles'])}, doubles: {len(matchmaking_queue['doubles'])} | 活跃对战数: {len(active_battles)}")
-
-                # 创建战斗实例
-                battle = BattleInstance(
-                    battle_id,
-                    player1,
-                    player2,
-                    "singles",
-                    log_callback=None  # 先设为空
-                )
-
-                # +++ 如果战斗因超限已结束，立即处理结果 +++
-                if battle.ended and battle.result_pending:
-                    await handle_battle_result(BattleResult(
-                        battle_id=battle_id,
-                        winner=battle.result["winner"],
-                        loser=battle.result["loser"]
-                    ))
-                    continue  # 跳过后续流程
-
-                # 再手动绑定 log 回调
-                battle.log_callback = lambda msg: asyncio.create_task(broadcast_battle_log(battle, msg))
-                active_battles[battle_id] = battle
-
-                # 添加调试日志
-                logger.info(f"创建对战: {battle_id}")
-                logger.info(f"玩家1 ID: {player1['player_id']}, 服务器: {online_players.get(player1['player_id'])}")
-                logger.info(f"玩家2 ID: {player2['player_id']}, 服务器: {online_players.get(player2['player_id'])}")
-
-                # 宝可梦使用记录
-                record_pokemon_usage(player1, player2)
-
-                # 通知双方玩家
-                for player, opponent in [(player1, player2), (player2, player1)]:
-                    server_id = online_players.get(player["player_id"])
-                    if server_id:
-                        opponent_active = opponent["pokemons"][0]
-
-                        self_team = [
-                            {
-                                "slot": idx + 1,
-                                "name": p["name"],
-                                "name_key": p["name_key"],
-                                "level": p["level"],
-                                "types": p["types"],
-                                "hp": p["hp"],
-                                "max_hp": p["max_hp"],
-                                "moves": p.get("moves", []),
-                                "status": p.get("status")
-                            }
-                            for idx, p in enumerate(player["pokemons"])
-                        ]
-
-                        await manager.send_message({
-                            "type": "match_found",
-                            "battle_id": battle_id,
-                            "self_id": player["player_id"],
-                            "opponent": opponent["player_id"],
-                            "opponent_name": opponent["player_name"],
-                            "opponent_active": {
-                                "name": opponent_active["name"],
-                                "name_key": opponent_active["name_key"],
-                                "level": opponent_active["level"],
-                                "types": opponent_active["types"],
-                                "moves": opponent_active.get("moves", []),
-                            },
-                            "opponent_team": [
-                                {
-                                    "name": p["name"],
-                                    "name_key": p["name_key"],
-                                    "level": p["level"],
-                                    "moves": p.get("moves", []),
-                                }
-                                for p in opponent["pokemons"]
-                            ],
-                            "self_team": self_team,
-                            "mode": "singles"
-                        }, server_id)
-                    else:
-                        logger.warning(f"找不到玩家 {player['player_id']} 的服务器")
-
-def get_rating_safe(player_id: str) -> int:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        return get_rating(player_id, cursor)
+def next_widening(mode: str, player_id: str) -> Optional[float]:
+    """玩家下一次放宽评分容忍度的时间；已离队或不再放宽时返回 None"""
+    entry = shards[mode].queue.get(player_id)
+    if entry is None:
+        return None
+    now = time.time()
+    step = tolerance_schedule.next_step_in(now - entry["join_time"])
+    return None if step is None else now + step
+
+async def check_matches(mode: str = "singles", players: Optional[List[str]] = None):
+    """检查并创建匹配（单个模式分片的一次匹配）
+
+    players 为 None 时遍历整个队列；否则只为这些新加入、评分变化或容忍度刚放宽的玩家查找对手。
+    """
+    queue = shards[mode].queue
+
+    if len(queue) < 2:
+        return
+
+    now = time.time()
+    entries = queue.entries
+
+    def tolerance_of(player_id: str) -> int:
+        return tolerance_schedule.tolerance(now - entries[player_id]["join_time"])
+
+    def can_pair(pid1: str, pid2: str) -> bool:
+        # 同服玩家在分区查找时已被排除，这里只需检查玩家是否在线
+        return pid1 in online_players and pid2 in online_players
+
+    # 先同步移出队列，避免并发的匹配检查重复配对
+    matched = []
+
+    def take(player1: Dict, player2: Dict, gap: int, batch: bool):
+        for player in (player1, player2):
+            shards[mode].wait_stats.record(now - player["join_time"])
+            forget_rating(player["player_id"])
+        shards[mode].pairing_stats.record_pair(gap, batch)
+        matched.append((player1, player2))
+
+    if BATCH_PAIRING and players is None:
+        # 批量配对：在计算预算内求整个队列的最小代价配对，超出预算的部分交给下面的贪心配对
+        started = time.perf_counter()
+        batch_pairs, completed = find_pairs_batch(queue, tolerance_of, can_pair, BATCH_BUDGET_MS / 1000)
+        shards[mode].pairing_stats.record_batch(time.perf_counter() - started, completed)
+        for pid1, pid2 in batch_pairs:
+            gap = abs(queue.rating_of(pid1) - queue.rating_of(pid2))
+            take(queue.remove(pid1), queue.remove(pid2), gap, True)
+        if not completed:
+            logger.info(f"{mode} 批量配对超出 {BATCH_BUDGET_MS}ms 预算，剩余 {len(queue)} 名玩家改用贪心配对")
+
+    # 队列按加入时间排列，等待最久的玩家先在其他子服分区的 ±容忍度窗口内挑选对手
+    for player1, player2, gap in find_pairs(queue, tolerance_of, can_pair, players):
+        take(player1, player2, gap, False)
+
+    for player1, player2 in matched:
+        await create_match(player1, player2, mode)
+
+def battle_log_callback(battle: BattleInstance):
+    # 发送只是入队，无需为每批事件创建任务
+    return lambda events: broadcast_battle_events(battle, events)
+
+async def create_match(player1: Dict, player2: Dict, mode: str):
+    """为已配对的两名玩家创建对战并通知子服"""
+    # 取消匹配超时定时器
+    for player_id in [player1["player_id"], player2["player_id"]]:
+        match_timers.cancel(player_id)
+
+    # 记录对战
+    battle_id = await record_battle(player1, player2, mode)
+
+    logger.info(
+        f"[匹配成功] {player1['player_name']}（{player1['player_id']}） vs {player2['player_name']}（{player2['player_id']}） | 模式: {mode} | 对战ID: {battle_id}")
+    logger.info(
+        f"[队列状态] singles: {len(matchmaking_queue['singles'])}, doubles: {len(matchmaking_queue['doubles'])} | 活跃对战数: {len(active_battles)}")
+
+    # 创建战斗实例
+    battle = BattleInstance(
+        battle_id,
+        player1,
+        player2,
+        mode,
+        log_callback=None  # 先设为空
+    )
+
+    # +++ 如果战斗因超限已结束，立即处理结果 +++
+    if battle.ended and battle.result_pending:
+        await handle_battle_result(BattleResult(
+            battle_id=battle_id,
+            winner=battle.result["winner"],
+            loser=battle.result["loser"]
+        ))
+        return  # 跳过后续流程
+
+    # 再手动绑定 log 回调
+    battle.log_callback = battle_log_callback(battle)
+    active_battles[battle_id] = battle
+
+    # 添加调试日志
+    logger.info(f"创建对战: {battle_id}")
+    logger.info(f"玩家1 ID: {player1['player_id']}, 服务器: {online_players.get(player1['player_id'])}")
+    logger.info(f"玩家2 ID: {player2['player_id']}, 服务器: {online_players.get(player2['player_id'])}")
+
+    # 宝可梦使用记录
+    record_pokemon_usage(player1, player2)
+
+    # 通知双方玩家
+    for player, opponent in [(player1, player2), (player2, player1)]:
+        server_id = online_players.get(player["player_id"])
+        if server_id:
+            opponent_active = opponent["pokemons"][0]
+
+            self_team = [
+                {
+                    "slot": idx + 1,
+                    "name": p["name"],
+                    "name_key": p["name_key"],
+                    "level": p["level"],
+                    "types": p["types"],
+                    "hp": p["hp"],
+                    "max_hp": p["max_hp"],
+                    "moves": p.get("moves", []),
+                    "status": p.get("status")
+                }
+                for idx, p in enumerate(player["pokemons"])
+            ]
+
+            await manager.send_message({
+                "type": "match_found",
+                "battle_id": battle_id,
+                "self_id": player["player_id"],
+                "opponent": opponent["player_id"],
+                "opponent_name": opponent["player_name"],
+                "opponent_active": {
+                    "name": opponent_active["name"],
+                    "name_key": opponent_active["name_key"],
+                    "level": opponent_active["level"],
+                    "types": opponent_active["types"],
+                    "moves": opponent_active.get("moves", []),
+                },
+                "opponent_team": [
+                    {
+                        "name": p["name"],
+                        "name_key": p["name_key"],
+                        "level": p["level"],
+                        "moves": p.get("moves", []),
+                    }
+                    for p in opponent["pokemons"]
+                ],
+                "self_team": self_team,
+                "mode": mode
+            }, server_id)
+        else:
+            logger.warning(f"找不到玩家 {player['player_id']} 的服务器")
 
 # ===================== 后台任务 =====================
 async def server_monitor():
@@ -1035,11 +1525,6 @@ async def server_monitor():
                 logger.warning(f"对战 {battle_id} 超时，强制结束")
                 del active_battles[battle_id]
 
-async def periodic_match_check():
-    while True:
-        await asyncio.sleep(3)
-        await check_matches()
-
 
 async def periodic_battle_processing():
     """定期处理战斗结果"""
@@ -1081,7 +1566,7 @@ async def handle_ws_message(message: Dict, server_id: str):
 
         if msg_type == "ping":
             manager.last_ping[server_id] = time.time()
-            await manager.send_message({"type": "pong"}, server_id)
+            await manager.send_message({"type": "pong"}, server_id, key="pong")
 
         elif msg_type == "request_battle_state":
             battle_id = message.get("battle_id")
@@ -1111,6 +1596,7 @@ async def handle_ws_message(message: Dict, server_id: str):
 
                 # 重置行动选择状态
                 battle.action_choices[cmd.player_id] = True
+                battle.revision += 1  # 之后的指令即使无效也已占用本回合的行动，快照需要包含
                 if battle:
                     try:
                         command_data = json.loads(cmd.command)
@@ -1121,16 +1607,7 @@ async def handle_ws_message(message: Dict, server_id: str):
                             logger.error(f"无效的指令格式: {cmd.command}")
                             return
 
-                    if command_data.get("type") == "switch":
-                        slot = command_data.get("slot")
-                        if not slot:
-                            logger.error("缺少切换槽位参数")
-                            return
-
-                        # 执行宝可梦切换
-                        battle.execute_switch(cmd.player_id, {"slot": slot})
-
-                    elif command_data.get("type") == "forfeit":
+                    if command_data.get("type") == "forfeit":
                         loser_id = cmd.player_id
                         winner_id = next(pid for pid in battle.players if pid != loser_id)
                         await handle_battle_result(BattleResult(
@@ -1149,20 +1626,32 @@ async def handle_ws_message(message: Dict, server_id: str):
                                     "winner": winner_id
                                 }, srv)
                         return
-                    battle.set_action(cmd.player_id, command_data)
-                    if battle.can_proceed():
-                        battle.process_turn()
-                        if battle.ended:
-                            winner_id = battle.winner
-                            loser_id = next(pid for pid in battle.players if pid != winner_id)
-                            await handle_battle_result(BattleResult(
-                                battle_id=cmd.battle_id,
-                                winner=winner_id,
-                                loser=loser_id
-                            ))
-                            # +++ 安全删除对战 +++
-                            if cmd.battle_id in active_battles:
-                                del active_battles[cmd.battle_id]
+                    # 切换、选择行动与随之触发的回合结算合并为一批事件发出
+                    with battle.batched_events():
+                        if command_data.get("type") == "switch":
+                            slot = command_data.get("slot")
+                            if not slot:
+                                logger.error("缺少切换槽位参数")
+                                return
+
+                            # 执行宝可梦切换
+                            battle.execute_switch(cmd.player_id, {"slot": slot})
+
+                        battle.set_action(cmd.player_id, command_data)
+                        proceed = battle.can_proceed()
+                        if proceed:
+                            battle.process_turn()
+                    if proceed and battle.ended:
+                        winner_id = battle.winner
+                        loser_id = next(pid for pid in battle.players if pid != winner_id)
+                        await handle_battle_result(BattleResult(
+                            battle_id=cmd.battle_id,
+                            winner=winner_id,
+                            loser=loser_id
+                        ))
+                        # +++ 安全删除对战 +++
+                        if cmd.battle_id in active_battles:
+                            del active_battles[cmd.battle_id]
             except Exception as e:
                 logger.error(f"处理指令时出错: {e}", exc_info=True)
 
@@ -1224,7 +1713,7 @@ async def send_battle_state_to_server(battle: BattleInstance, server_id: str):
         "battle_id": battle.battle_id,
         "turn": battle.turn,
         "view": view
-    }, server_id)
+    }, server_id, key=f"battle_update:{battle.battle_id}:{player_id}")
 
 def build_player_view(battle: BattleInstance, player_id: str) -> dict:
     """为特定玩家构建战斗视图"""
@@ -1260,6 +1749,7 @@ def build_player_view(battle: BattleInstance, player_id: str) -> dict:
     if battle.players[player_id].get("auto_switched"):
         player_view["auto_switched"] = True
         battle.players[player_id]["auto_switched"] = False  # 重置标志
+        battle.revision += 1
     else:
         player_view["auto_switched"] = False
 
@@ -1323,28 +1813,49 @@ async def broadcast_battle_state(battle: BattleInstance):
                 "battle_id": battle.battle_id,
                 "turn": battle.turn,
                 "view": view
-            }, server_id)
+            }, server_id, key=f"battle_update:{battle.battle_id}:{player_id}")
 
 # ===================== 战斗结果处理 =====================
 async def handle_battle_result(result: BattleResult):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-
-        old_winner = get_rating(result.winner, cursor)
-        old_loser = get_rating(result.loser, cursor)
-
-        cursor.execute("""
-            UPDATE battles 
-            SET winner = ?
-            WHERE battle_id = ?
-        """, (result.winner, result.battle_id))
+    # 投降、超时处理与子服上报可能先后提交同一对战的结果
+    if not settlement_guard.claim(result.battle_id):
+        logger.info(f"对战 {result.battle_id} 已结算，忽略重复结果")
+        active_battles.pop(result.battle_id, None)
+        return {"message": "该对战已结算"}
 
-        calculate_elo(result.winner, result.loser, cursor)
-
-        new_winner = get_rating(result.winner, cursor)
-        new_loser = get_rating(result.loser, cursor)
-
-        conn.commit()
+    # 结算立即提交，且排在该对战的记录写入之后
+    try:
+        outcome = await write_behind.write_now(
+            settle_battle,
+            result.battle_id,
+            result.winner,
+            result.loser,
+            player_names.get(result.winner, result.winner),
+            player_names.get(result.loser, result.loser),
+            beijing_time().isoformat()
+        )
+    except Exception:
+        settlement_guard.release(result.battle_id)
+        raise
+    settlement_guard.complete(result.battle_id, duplicate=outcome is None)
+    if outcome is None:
+        logger.info(f"对战 {result.battle_id} 不存在、已归档或已结算，忽略该结果")
+        active_battles.pop(result.battle_id, None)
+        return {"message": "该对战不存在或已结算"}
+
+    old_winner, new_winner = outcome["winner_before"], outcome["winner_after"]
+    old_loser, new_loser = outcome["loser_before"], outcome["loser_after"]
+    for player in outcome["players"]:
+        leaderboard.upsert(**player)
+
+    # 提交后写穿评分缓存（缓存只保存排队中的玩家）
+    for shard in shards.values():
+        for player_id, rating in ((result.winner, new_winner), (result.loser, new_loser)):
+            if player_id in shard.queue:
+                rating_cache.set(player_id, rating)
+                shard.queue.update_rating(player_id, rating)
+                # 排队中的玩家评分变化可能产生新的配对
+                shard.notify(player_id)
 
     if result.battle_id in active_battles:
         del active_battles[result.battle_id]
@@ -1359,42 +1870,150 @@ async def handle_battle_result(result: BattleResult):
         f"{old_loser} → {new_loser} ({new_loser - old_loser})"
     )
 
-    # 按服务器分组发送消息
-    server_messages = {}
+    # 按服务器分组发送消息；消息头与每条 Elo 更新各只编码一次，再按服务器拼接
+    server_updates: Dict[str, List[str]] = {}
     for player_id in [result.winner, result.loser]:
         server_id = online_players.get(player_id)
         if server_id:
-            if server_id not in server_messages:
-                server_messages[server_id] = {
-                    "elo_updates": [],
-                    "battle_ended": False
-                }
-
-            # 添加ELO更新
             elo_change = new_winner - old_winner if player_id == result.winner else new_loser - old_loser
-            server_messages[server_id]["elo_updates"].append({
+            server_updates.setdefault(server_id, []).append(manager.encode({
                 "player_id": player_id,
                 "old_rating": old_winner if player_id == result.winner else old_loser,
                 "new_rating": new_winner if player_id == result.winner else new_loser,
                 "rating_change": elo_change
-            })
+            }))
 
-    # 发送合并消息
-    for server_id, messages in server_messages.items():
-        await manager.send_message({
-            "type": "battle_result",
-            "battle_id": result.battle_id,
-            "winner": result.winner,
-            "elo_updates": messages["elo_updates"]
-        }, server_id)
+    head = manager.encode({
+        "type": "battle_result",
+        "battle_id": result.battle_id,
+        "winner": result.winner
+    })
+    for server_id, updates in server_updates.items():
+        await manager.send_frame(frames.with_encoded_list(head, "elo_updates", updates), server_id)
 
     return {"message": "战斗结束，Elo 分数已更新"}
 
+# ===================== 状态快照 =====================
+SNAPSHOT_CHUNK = 100  # 每次让出事件循环前序列化的对战数
+battle_snapshots: Dict[str, tuple] = {}  # battle_id -> (revision, JSON 编码结果)，未变化的对战复用上次结果
+
+async def encode_battles() -> Dict[str, bytes]:
+    """逐个序列化活跃对战，分批让出事件循环"""
+    battles = list(active_battles.values())
+    for start in range(0, len(battles), SNAPSHOT_CHUNK):
+        for battle in battles[start:start + SNAPSHOT_CHUNK]:
+            cached = battle_snapshots.get(battle.battle_id)
+            if cached is None or cached[0] != battle.revision:
+                battle_snapshots[battle.battle_id] = (battle.revision, encode_state(battle.to_snapshot()))
+        await asyncio.sleep(0)
+
+    # 期间结束的对战不写入快照
+    for battle_id in [bid for bid in battle_snapshots if bid not in active_battles]:
+        del battle_snapshots[battle_id]
+    return {battle_id: blob for battle_id, (_, blob) in battle_snapshots.items()}
+
+def capture_state() -> Dict:
+    """收集需要跨重启保留的运行状态（对战另行拼接）"""
+    queues = {}
+    timers = {}
+    for mode, shard in shards.items():
+        queues[mode] = [(entry, shard.queue.rating_of(entry["player_id"])) for entry in shard.queue]
+        for entry in shard.queue:
+            remaining = match_timers.remaining(entry["player_id"])
+            if remaining is not None:
+                timers[entry["player_id"]] = (remaining, match_timers.payload(entry["player_id"]))
+
+    return {
+        "taken_at": time.time(),
+        "queues": queues,
+        "timers": timers,
+        "online_players": online_players,
+        "player_names": player_names,
+        "player_server": manager.player_server
+    }
+
+async def save_snapshot():
+    battles = await encode_battles()
+    # 其余状态很小，在事件循环中一次性序列化以保证一致；对战沿用各自缓存的编码，拼接、压缩与落盘交给线程
+    chunks = with_encoded_list(encode_state(capture_state()), "battles", list(battles.values()))
+    await asyncio.get_running_loop().run_in_executor(None, write_snapshot, SNAPSHOT_FILE, chunks)
+
+async def periodic_snapshot():
+    """定期保存运行状态快照"""
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            await save_snapshot()
+        except Exception as e:
+            logger.error(f"保存状态快照失败: {e}")
+
+def restore_snapshot():
+    """启动时从快照恢复队列、玩家与对战，定时器按剩余时长重新计时"""
+    try:
+        state = read_snapshot(SNAPSHOT_FILE)
+    except Exception as e:
+        logger.error(f"读取状态快照失败: {e}")
+        return
+    if state is None:
+        return
+    age = time.time() - state["taken_at"]
+    if age > SNAPSHOT_MAX_AGE:
+        logger.info(f"状态快照已过期（{age:.0f} 秒前），不予恢复")
+        return
+
+    player_names.update(state["player_names"])
+    online_players.update(state["online_players"])
+    for player_id, server_id in state["player_server"].items():
+        manager.update_player_server(player_id, server_id)
+
+    for mode, entries in state["queues"].items():
+        if mode not in shards or not shards[mode].enabled:
+            continue
+        for entry, rating in entries:
+            rating_cache.set(entry["player_id"], rating)
+            shards[mode].queue.add(entry, rating_cache.get(entry["player_id"]))
+    for player_id, (remaining, mode) in state["timers"].items():
+        match_timers.schedule(player_id, remaining, mode)
+
+    for battle_state in state["battles"]:
+        battle = BattleInstance.from_snapshot(battle_state, state["taken_at"], log_callback=None)
+        battle.log_callback = battle_log_callback(battle)
+        active_battles[battle.battle_id] = battle
+
+    logger.info(
+        f"已从快照恢复（{age:.0f} 秒前）| 队列: "
+        f"{', '.join(f'{mode} {len(shard.queue)}' for mode, shard in shards.items())} | 对战: {len(active_battles)}")
+
+async def migrate_team_storage():
+    """把旧对战记录中内联的队伍分批迁移到 teams 表（在写线程上逐批执行，不阻塞启动）"""
+    migrated, after = 0, 0
+    while True:
+        rows, after = await db.run(migrate_battle_teams_chunk, TEAM_COMPRESSION, after)
+        if not rows:
+            break
+        migrated += rows
+    if not migrated:
+        return
+    if not VACUUM_AFTER_MIGRATION:
+        logger.info(f"已迁移 {migrated} 条对战记录的队伍数据，可在低峰期 VACUUM 回收空间")
+        return
+    logger.info(f"已迁移 {migrated} 条对战记录的队伍数据，正在压缩数据库文件")
+    await db.run(lambda conn: conn.execute("VACUUM"))
+
 async def main():
-    asyncio.create_task(periodic_match_check())
+    restore_snapshot()
+    # 各模式分片各有一个匹配协程，在同一事件循环内交替运行
+    for shard in shards.values():
+        if shard.enabled:
+            shard.start(check_matches, next_widening)
+    match_timers.start(expire_queue_entries)
     asyncio.create_task(server_monitor())
     asyncio.create_task(record_status_history())
+    asyncio.create_task(sample_status_rollups())
+    asyncio.create_task(periodic_snapshot())
     asyncio.create_task(periodic_battle_processing())
+    asyncio.create_task(periodic_usage_flush())
+    asyncio.create_task(migrate_team_storage())
 
     config = uvicorn.Config(
         app,
@@ -1405,6 +2024,12 @@ async def main():
     )
     server = uvicorn.Server(config)
     await server.serve()
+    # 退出前保存快照、写回内存计数、提交写后队列并等待数据库线程中的写入完成
+    await save_snapshot()
+    await flush_pokemon_usage()
+    await write_behind.close()
+    db.close()
+    season_archives.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
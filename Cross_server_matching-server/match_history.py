@@ -0,0 +1,44 @@
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+HISTORY_COLUMNS = "battle_id, timestamp, player1, player2, mode, winner, winner_elo_change, loser_elo_change"
+
+
+def create_history_indexes(cursor: sqlite3.Cursor):
+    """按玩家查询对战的覆盖索引，并补齐记录评分变化的列"""
+    columns = {row[1] for row in cursor.execute("PRAGMA table_info(battles)")}
+    for column in ("winner_elo_change", "loser_elo_change"):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE battles ADD COLUMN {column} INTEGER")
+
+    # 索引包含查询所需的全部列，翻页只读索引不回表
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_battles_player1_history
+        ON battles(player1, timestamp, battle_id, player2, mode, winner, winner_elo_change, loser_elo_change)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_battles_player2_history
+        ON battles(player2, timestamp, battle_id, player1, mode, winner, winner_elo_change, loser_elo_change)
+    """)
+
+
+def fetch_player_battles(conn: sqlite3.Connection, player_id: str, limit: int,
+                         before: Optional[Tuple[str, str]] = None) -> List[Dict]:
+    """按 (timestamp, battle_id) 倒序取玩家的对战，before 为上一页最后一条的键"""
+    keyset = "AND (timestamp, battle_id) < (?, ?)" if before else ""
+    side_params = [player_id] + (list(before) if before else []) + [limit]
+    rows = conn.execute(f"""
+        SELECT * FROM (
+            SELECT {HISTORY_COLUMNS} FROM battles
+            WHERE player1 = ? {keyset}
+            ORDER BY timestamp DESC, battle_id DESC LIMIT ?
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT {HISTORY_COLUMNS} FROM battles
+            WHERE player2 = ? {keyset}
+            ORDER BY timestamp DESC, battle_id DESC LIMIT ?
+        )
+        ORDER BY timestamp DESC, battle_id DESC LIMIT ?
+    """, side_params + side_params + [limit]).fetchall()
+    return [dict(row) for row in rows]
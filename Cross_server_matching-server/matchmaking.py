@@ -0,0 +1,543 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from heapq import heapify, heappop, heappush
+from collections import deque
+from itertools import repeat
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("matchmaking")
+
+DEFAULT_RATING = 1000
+MIN_RECHECK_INTERVAL = 1.0  # 容忍度放宽触发的重新匹配最短间隔（秒），其间到期的玩家合并为一次增量匹配
+BATCH_WINDOW = 6  # 批量配对时一名玩家最多与评分序中后面第几个玩家配对
+
+
+class RatingCache:
+    """进程内评分缓存（写穿），匹配器只从这里读取评分；只保存排队中的玩家，离队时移除"""
+
+    def __init__(self, default_rating: int = DEFAULT_RATING):
+        self.default_rating = default_rating
+        self._ratings: Dict[str, int] = {}
+
+    def get(self, player_id: str) -> int:
+        """读取评分，未缓存的玩家按默认分处理"""
+        return self._ratings.get(player_id, self.default_rating)
+
+    def set(self, player_id: str, rating: Optional[int]):
+        """数据库提交后写入最新评分"""
+        self._ratings[player_id] = self.default_rating if rating is None else int(rating)
+
+    def discard(self, player_id: str):
+        """玩家离开队列（离队、匹配成功、超时）后移除"""
+        self._ratings.pop(player_id, None)
+
+    def clear(self):
+        """评分整体重置（赛季切换）后丢弃全部缓存"""
+        self._ratings.clear()
+
+    def __contains__(self, player_id: str) -> bool:
+        return player_id in self._ratings
+
+    def __len__(self) -> int:
+        return len(self._ratings)
+
+
+class RatingIndex:
+    """按评分排序的匹配索引（bisect 维护的有序数组，增删都在原数组上完成，数组中没有失效项）"""
+
+    def __init__(self):
+        self._keys: List[Tuple[int, int]] = []  # (评分, 加入序号)，序号保证同分先到先配
+        self._ratings: List[int] = []  # 与 _keys 平行的评分，查找时直接对整数数组 bisect
+        self._ids: List[str] = []
+        self._key_of: Dict[str, Tuple[int, int]] = {}
+        self._seq = 0
+
+    def add(self, player_id: str, rating: int):
+        self.remove(player_id)
+        self._seq += 1
+        key = (rating, self._seq)
+        pos = bisect_left(self._keys, key)
+        self._keys.insert(pos, key)
+        self._ratings.insert(pos, rating)
+        self._ids.insert(pos, player_id)
+        self._key_of[player_id] = key
+
+    def remove(self, player_id: str) -> bool:
+        key = self._key_of.pop(player_id, None)
+        if key is None:
+            return False
+        # 键唯一，bisect 直接定位；删除只是一次内存搬移，与插入同量级
+        pos = bisect_left(self._keys, key)
+        del self._keys[pos]
+        del self._ratings[pos]
+        del self._ids[pos]
+        return True
+
+    def update(self, player_id: str, rating: int):
+        """评分变化时重新定位（仅对已在索引中的玩家生效）"""
+        key = self._key_of.get(player_id)
+        if key is not None and key[0] != rating:
+            self.add(player_id, rating)
+
+    def rating_of(self, player_id: str) -> Optional[int]:
+        key = self._key_of.get(player_id)
+        return key[0] if key else None
+
+    def view(self) -> Tuple[List[int], List[str]]:
+        """返回内部 (评分列表, 玩家列表) 的只读引用，增删后原位置即失效"""
+        return self._ratings, self._ids
+
+    def snapshot(self) -> Tuple[List[int], List[str]]:
+        """返回按评分升序的 (评分列表, 玩家列表) 副本"""
+        return list(self._ratings), list(self._ids)
+
+    def __contains__(self, player_id: str) -> bool:
+        return player_id in self._key_of
+
+    def __len__(self) -> int:
+        return len(self._key_of)
+
+
+class MatchQueue:
+    """匹配队列：player_id -> 条目映射（保持加入顺序，即等待时间从长到短）+ 按来源子服分区的评分索引"""
+
+    def __init__(self):
+        self.entries: Dict[str, Dict] = {}
+        self.partitions: Dict[str, RatingIndex] = {}  # 子服 -> 该子服玩家的评分索引
+
+    def add(self, entry: Dict, rating: int):
+        player_id = entry["player_id"]
+        self.remove(player_id)  # 重新加入时排到队尾
+        self.entries[player_id] = entry
+        self.partitions.setdefault(entry["server"], RatingIndex()).add(player_id, rating)
+
+    def remove(self, player_id: str) -> Optional[Dict]:
+        entry = self.entries.pop(player_id, None)
+        if entry is not None:
+            partition = self.partitions.get(entry["server"])
+            if partition is not None:
+                partition.remove(player_id)
+                if not partition:
+                    del self.partitions[entry["server"]]
+        return entry
+
+    def update_rating(self, player_id: str, rating: int):
+        entry = self.entries.get(player_id)
+        if entry is not None:
+            self.partitions[entry["server"]].update(player_id, rating)
+
+    def rating_of(self, player_id: str) -> Optional[int]:
+        entry = self.entries.get(player_id)
+        return self.partitions[entry["server"]].rating_of(player_id) if entry else None
+
+    def get(self, player_id: str) -> Optional[Dict]:
+        return self.entries.get(player_id)
+
+    def clear(self):
+        self.entries.clear()
+        self.partitions.clear()
+
+    def __contains__(self, player_id: str) -> bool:
+        return player_id in self.entries
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class ToleranceSchedule:
+    """按等待时间放宽的评分容忍度：每等待满一分钟增加 per_minute，最多放宽到 cap"""
+
+    def __init__(self, base: int, per_minute: int = 0, cap: Optional[int] = None):
+        self.base = base
+        self.per_minute = per_minute
+        self.cap = cap
+
+    def tolerance(self, waited: float) -> int:
+        if self.per_minute <= 0:
+            return self.base
+        widened = self.base + int(max(0.0, waited) // 60) * self.per_minute
+        return widened if self.cap is None else max(self.base, min(widened, self.cap))
+
+    def next_step_in(self, waited: float) -> Optional[float]:
+        """距离下一次放宽还有多少秒；不再放宽时返回 None"""
+        if self.per_minute <= 0:
+            return None
+        if self.cap is not None and self.tolerance(waited) >= self.cap:
+            return None
+        return 60 - max(0.0, waited) % 60
+
+
+class WaitTimeStats:
+    """最近匹配成功玩家的等待时间（秒），用于统计分位数"""
+
+    def __init__(self, maxlen: int = 1000):
+        self._samples = deque(maxlen=maxlen)
+        self.total = 0
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+        self.total += 1
+
+    def percentiles(self) -> Dict[str, float]:
+        ordered = sorted(self._samples)
+        result = {"samples": len(ordered), "total": self.total}
+        for name, pct in (("p50", 50), ("p95", 95), ("p99", 99)):
+            if ordered:
+                result[name] = round(ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))], 1)
+            else:
+                result[name] = 0.0
+        return result
+
+
+class PairingStats:
+    """配对质量与耗时统计（贪心与批量配对分别计数）"""
+
+    def __init__(self):
+        self.pairs = 0
+        self.total_gap = 0
+        self.max_gap = 0
+        self.batch_passes = 0
+        self.batch_fallbacks = 0  # 超出计算预算、剩余部分改用贪心的次数
+        self.batch_pairs = 0
+        self.last_solve_ms = 0.0
+        self.total_solve_ms = 0.0
+
+    def record_pair(self, gap: int, batch: bool):
+        self.pairs += 1
+        self.total_gap += gap
+        self.max_gap = max(self.max_gap, gap)
+        if batch:
+            self.batch_pairs += 1
+
+    def record_batch(self, seconds: float, completed: bool):
+        self.batch_passes += 1
+        self.last_solve_ms = seconds * 1000
+        self.total_solve_ms += seconds * 1000
+        if not completed:
+            self.batch_fallbacks += 1
+
+    def summary(self) -> Dict:
+        return {
+            "pairs": self.pairs,
+            "avg_gap": round(self.total_gap / self.pairs, 1) if self.pairs else 0.0,
+            "max_gap": self.max_gap,
+            "batch_passes": self.batch_passes,
+            "batch_pairs": self.batch_pairs,
+            "batch_fallbacks": self.batch_fallbacks,
+            "last_solve_ms": round(self.last_solve_ms, 3),
+            "avg_solve_ms": round(self.total_solve_ms / self.batch_passes, 3) if self.batch_passes else 0.0
+        }
+
+
+def nearest_cross_server_gaps(queue: MatchQueue) -> Dict[str, Optional[int]]:
+    """每名玩家与最近的其他子服玩家的分差，没有其他子服玩家时为 None（一次排序加两次线性扫描，O(n log n)）
+
+    之后配对只会移出玩家，分差只增不减，因此它是整次全量匹配中的下界。
+    """
+    players = []  # (评分, 子服, player_id)
+    for server, index in queue.partitions.items():
+        ratings, ids = index.view()
+        players.extend(zip(ratings, repeat(server), ids))
+    if not players:
+        return {}
+    players.sort()
+    ratings, servers, ids = zip(*players)
+    n = len(players)
+    gaps: List[Optional[int]] = [None] * n
+    # other 为离当前位置最近的不同服玩家：前一名玩家不同服时就是它，否则沿用前一名玩家的
+    other = -1
+    for i in range(1, n):
+        if servers[i - 1] != servers[i]:
+            other = i - 1
+        if other >= 0:
+            gaps[i] = ratings[i] - ratings[other]
+    other = n
+    for i in range(n - 2, -1, -1):
+        if servers[i + 1] != servers[i]:
+            other = i + 1
+        if other < n and (gaps[i] is None or ratings[other] - ratings[i] < gaps[i]):
+            gaps[i] = ratings[other] - ratings[i]
+    return dict(zip(ids, gaps))
+
+
+def find_pairs(queue: MatchQueue, tolerance_of: Callable[[str], int], can_pair: Callable[[str, str], bool],
+               players: Optional[Iterable[str]] = None) -> List[Tuple[Dict, Dict, int]]:
+    """贪心配对：等待最久的玩家先在其他子服分区的 ±容忍度窗口内取评分最接近的合格对手
+
+    players 为 None 时按加入顺序查找整个队列；否则只为给出的玩家查找对手（增量匹配），
+    其余玩家之间在上一次匹配后没有变化，不会产生新的配对。增量匹配时对手自己的容忍度也算数：
+    查找范围放宽到队首玩家（等待最久、容忍度最大）的容忍度，分差在任一方容忍度内即可配对，
+    与该对手在全量匹配中主动查找的结果一致。
+
+    直接在各分区维护中的评分索引上查找，不复制索引：每个分区用 bisect 定位后向上、向下各取一个候选，
+    多路合并按分差从小到大尝试，同服玩家根本不会被扫描到，查找开销只取决于可匹配的对手。
+    配对成功的双方立即移出队列，返回 [(条目1, 条目2, 分差)]。
+    """
+    partitions = queue.partitions
+    # 增删都在原数组上进行，引用在整次查找中保持有效（分区清空后只是空数组）
+    views = {server: index.view() for server, index in partitions.items()}
+
+    def push_next(heap: list, server: str, j: int, step: int, rating: int, tolerance: int):
+        ratings = views[server][0]
+        if 0 <= j < len(ratings) and abs(ratings[j] - rating) <= tolerance:
+            heappush(heap, (abs(ratings[j] - rating), step, server, j))
+
+    widest = 0
+    lower_bounds: Dict[str, Optional[int]] = {}
+    if players is not None and queue.entries:
+        widest = tolerance_of(next(iter(queue.entries)))
+    elif len(partitions) >= 2:
+        # 全量匹配先用一次排序排除容忍度内没有任何其他子服玩家的人，只有可能配对的玩家才逐个分区查找；
+        # 分差超过队首玩家（容忍度最大）容忍度的玩家连自己的容忍度都不必计算
+        lower_bounds = nearest_cross_server_gaps(queue)
+        ceiling = tolerance_of(next(iter(queue.entries)))
+
+    pairs = []
+    for player_id in list(queue.entries) if players is None else players:
+        if len(partitions) < 2:
+            break
+        entry = queue.get(player_id)
+        if entry is None:
+            continue  # 本次已配对
+        if lower_bounds:
+            bound = lower_bounds[player_id]
+            if bound is None or bound > ceiling:
+                continue
+        tolerance = tolerance_of(player_id)
+        reach = max(tolerance, widest)
+        if lower_bounds and bound > reach:
+            continue
+        own = entry["server"]
+        rating = partitions[own].rating_of(player_id)
+        # 每个其他分区在评分位置两侧各取一个候选
+        heap = []
+        for server, (ratings, _) in views.items():
+            if server == own:
+                continue
+            k = bisect_left(ratings, rating)
+            if k < len(ratings) and ratings[k] - rating <= reach:
+                heap.append((ratings[k] - rating, 1, server, k))
+            if k and rating - ratings[k - 1] <= reach:
+                heap.append((rating - ratings[k - 1], -1, server, k - 1))
+        heapify(heap)
+
+        while heap:
+            gap, step, server, j = heappop(heap)
+            opponent_id = views[server][1][j]
+            if (gap <= tolerance or gap <= tolerance_of(opponent_id)) and can_pair(player_id, opponent_id):
+                # 移出队列会改动分区数组，堆中的位置随即作废，因此配对后立即结束该玩家的查找
+                pairs.append((queue.remove(player_id), queue.remove(opponent_id), gap))
+                break
+            # 该方向的下一个候选
+            push_next(heap, server, j + step, step, rating, reach)
+    return pairs
+
+
+def find_pairs_batch(queue: MatchQueue, tolerance_of: Callable[[str], int], can_pair: Callable[[str, str], bool],
+                     budget: float, window: int = BATCH_WINDOW) -> Tuple[List[Tuple[str, str]], bool]:
+    """批量配对：对整个队列求最小代价配对（先使配对数最多，再使总分差最小）
+
+    按评分排序后以分差超过最大容忍度的位置切分成互不相连的分段，逐段做滑动窗口状态压缩 DP，
+    每名玩家只与评分序中后面 window - 1 名以内的玩家配对。超过 budget 秒时停止，
+    返回已完成分段的配对和 False，剩余玩家由调用方交给贪心配对。
+    """
+    deadline = time.perf_counter() + budget
+    players = []  # (评分, player_id, 子服, 容忍度)
+    for server, index in queue.partitions.items():
+        ratings, ids = index.snapshot()
+        players.extend((rating, player_id, server, tolerance_of(player_id)) for rating, player_id in zip(ratings, ids))
+    if len(players) < 2:
+        return [], True
+    players.sort()
+    max_tolerance = max(p[3] for p in players)
+
+    pairs = []
+    start = 0
+    for end in range(1, len(players) + 1):
+        if end < len(players) and players[end][0] - players[end - 1][0] <= max_tolerance:
+            continue
+        if end - start >= 2:
+            segment_pairs = _solve_segment(players[start:end], can_pair, window, deadline)
+            if segment_pairs is None:
+                return pairs, False
+            pairs.extend(segment_pairs)
+        start = end
+    return pairs, True
+
+
+def _solve_segment(players: List[tuple], can_pair: Callable[[str, str], bool], window: int,
+                   deadline: float) -> Optional[List[Tuple[str, str]]]:
+    """单个分段的滑动窗口 DP；超时返回 None"""
+    m = len(players)
+    # 可配对的 (偏移, 分差)，分差不超过双方中较大的容忍度
+    edges = []
+    for i, (rating, player_id, server, tolerance) in enumerate(players):
+        options = []
+        for d in range(1, min(window, m - i)):
+            other_rating, other_id, other_server, other_tolerance = players[i + d]
+            gap = other_rating - rating
+            if gap > max(tolerance, other_tolerance):
+                continue
+            if other_server != server and can_pair(player_id, other_id):
+                options.append((d, gap))
+        edges.append(options)
+
+    # 每名未配对玩家的惩罚大于任何一组配对的总分差，保证先最大化配对数
+    unmatched_cost = (max(p[3] for p in players) + 1) * m
+    # states[mask] = 代价；mask 的第 k 位表示位置 i + k 已被前面的玩家占用
+    states = {0: 0}
+    history = []  # 每个位置: {新 mask: (旧 mask, 配对偏移)}
+    for i in range(m):
+        if i % 64 == 0 and time.perf_counter() > deadline:
+            return None
+        next_states = {}
+        choices = {}
+        for mask, cost in states.items():
+            if mask & 1:
+                moves = [(mask >> 1, cost, 0)]
+            else:
+                moves = [(mask >> 1, cost + unmatched_cost, 0)]
+                for d, gap in edges[i]:
+                    if not mask & (1 << d):
+                        moves.append(((mask | (1 << d)) >> 1, cost + gap, d))
+            for new_mask, new_cost, d in moves:
+                if new_mask not in next_states or new_cost < next_states[new_mask]:
+                    next_states[new_mask] = new_cost
+                    choices[new_mask] = (mask, d)
+        states = next_states
+        history.append(choices)
+
+    # 回溯得到配对
+    pairs = []
+    mask = 0
+    for i in range(m - 1, -1, -1):
+        mask, d = history[i][mask]
+        if d:
+            pairs.append((players[i][1], players[i + d][1]))
+    pairs.reverse()
+    return pairs
+
+
+class MatchmakerLoop:
+    """单个模式的常驻匹配协程：队列有变化或容忍度放宽时被唤醒，突发的加入合并为一次匹配
+
+    加入或评分变化的玩家记入待查集合，唤醒后只为这些玩家查找对手（增量匹配）；
+    每名玩家下一次放宽容忍度的时间记在最小堆中，到期时也只为这些玩家重新查找对手；
+    只有启动和整体评分变化（快照恢复、赛季重置）时才遍历整个队列（全量匹配）。
+    """
+
+    def __init__(self, mode: str, run_pass: Callable[[Optional[List[str]]], Awaitable[None]],
+                 next_widening: Callable[[str], Optional[float]], players: Callable[[], Iterable[str]]):
+        self.mode = mode
+        self._run_pass = run_pass  # 参数为待查玩家列表，None 表示全量匹配
+        self._next_widening = next_widening  # 玩家下一次放宽的时间（time.time()），已离队或不再放宽时返回 None
+        self._players = players  # 队列中的全部玩家，全量匹配后据此重建放宽时间堆
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dirty: Dict[str, None] = {}  # 按通知顺序去重的待查玩家
+        self._deadlines: List[Tuple[float, str]] = []  # (放宽时间, player_id)，离队玩家的旧条目到期时丢弃
+        self._full = True
+        self.task: Optional[asyncio.Task] = None
+        self.passes = 0
+        self.full_passes = 0
+        self.widening_passes = 0
+
+    def start(self) -> asyncio.Task:
+        # Event 在事件循环内创建，避免绑定到错误的循环
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()  # 启动时先跑一次全量匹配，处理已有队列
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def notify(self, player_id: Optional[str] = None):
+        """唤醒匹配协程：给出玩家时只为其查找对手，否则下一次做全量匹配；匹配进行中收到的通知合并到下一次"""
+        if player_id is None:
+            self._full = True
+        else:
+            self._dirty[player_id] = None
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _schedule(self, player_ids: Iterable[str]):
+        """记录仍在队列中的玩家下一次放宽容忍度的时间"""
+        for player_id in player_ids:
+            at = self._next_widening(player_id)
+            if at is not None:
+                heappush(self._deadlines, (at, player_id))
+
+    def _pop_due(self) -> Dict[str, None]:
+        """取出放宽时间已到的玩家"""
+        now = time.time()
+        due: Dict[str, None] = {}
+        while self._deadlines and self._deadlines[0][0] <= now:
+            due[heappop(self._deadlines)[1]] = None
+        return due
+
+    async def run(self):
+        widen_after = 0.0  # 放宽触发的匹配之间至少间隔 MIN_RECHECK_INTERVAL（事件循环时钟），到期玩家合并处理
+        loop = asyncio.get_running_loop()
+        while True:
+            # 没有待放宽的玩家时只等通知，空闲队列不消耗任何资源
+            timeout = None
+            if self._deadlines:
+                timeout = max(0.0, self._deadlines[0][0] - time.time(), widen_after - loop.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            full, self._full = self._full, False
+            dirty, self._dirty = self._dirty, {}
+            due = {} if full else self._pop_due()
+            if due:
+                widen_after = loop.time() + MIN_RECHECK_INTERVAL
+                self.widening_passes += 1
+                dirty.update(due)
+            if not full and not dirty:
+                continue
+            try:
+                await self._run_pass(None if full else list(dirty))
+            except Exception as e:
+                logger.error(f"{self.mode} 匹配检查失败: {e}", exc_info=True)
+            self.passes += 1
+            if full:
+                self.full_passes += 1
+                self._deadlines = []
+                self._schedule(self._players())
+            else:
+                self._schedule(dirty)
+
+
+class MatchmakingShard:
+    """单个匹配模式的独立分片：自有队列（含评分索引）与匹配协程
+
+    各分片的匹配协程共用一个事件循环，匹配计算是同步的，一个模式的长时间匹配仍会推迟其他模式。
+    """
+
+    def __init__(self, mode: str, min_team_size: int = 1, enabled: bool = True):
+        self.mode = mode
+        self.min_team_size = min_team_size  # 该模式要求的最少宝可梦数量
+        self.enabled = enabled  # 对战引擎尚未支持的模式不接受加入，也不启动匹配协程
+        self.queue = MatchQueue()
+        self.wait_stats = WaitTimeStats()
+        self.pairing_stats = PairingStats()
+        self.loop: Optional[MatchmakerLoop] = None
+
+    def start(self, run_pass: Callable[[str, Optional[List[str]]], Awaitable[None]],
+              next_widening: Callable[[str, str], Optional[float]]) -> asyncio.Task:
+        self.loop = MatchmakerLoop(
+            self.mode,
+            lambda players: run_pass(self.mode, players),
+            lambda player_id: next_widening(self.mode, player_id),
+            lambda: list(self.queue.entries)
+        )
+        return self.loop.start()
+
+    def notify(self, player_id: Optional[str] = None):
+        if self.loop is not None:
+            self.loop.notify(player_id)
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+
+from database import LatencyStats
+
+logger = logging.getLogger("matchmaking")
+
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect", "coalesce")
+DROP_LOG_INTERVAL = 10.0  # 同一连接丢帧日志的最短间隔（秒）
+
+
+class _Item:
+    __slots__ = ("frame", "key", "enqueued_at")
+
+    def __init__(self, frame: str, key: Optional[str]):
+        self.frame: Optional[str] = frame  # 被合并后置为 None，写协程跳过
+        self.key = key
+        self.enqueued_at = time.monotonic()
+
+
+class OutboundChannel:
+    """一个子服连接的发送队列：发送方只入队，由独立的写协程逐帧发送
+
+    队列满时按策略处理：
+      drop_oldest  丢弃最早的一帧
+      disconnect   断开该连接，由子服重连后重新同步
+      coalesce     带合并键的帧总是替换队列中同键的旧帧；队列满时丢弃最早的一个带合并键的帧，
+                   队列中只剩无法合并的帧（配对、结算、战斗事件）时断开连接，由子服重连后重新同步
+    """
+
+    def __init__(self, server_id: str, send: Callable, limit: int = 1000, policy: str = "coalesce",
+                 send_timeout: float = 10.0, on_failure: Optional[Callable[[str, str], None]] = None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"未知的溢出策略: {policy}")
+        self.server_id = server_id
+        self.send = send
+        self.limit = limit
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.on_failure = on_failure
+        self._queue: Deque[_Item] = deque()
+        self._keyed: Dict[str, _Item] = {}
+        self._depth = 0  # 有效帧数（不含已被合并的）
+        self._ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.closed = False
+        self.latency = LatencyStats()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self._drop_logged_at = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, frame: str, key: Optional[str] = None) -> bool:
+        """入队一帧；连接已关闭或因溢出被断开时返回 False"""
+        if self.closed:
+            return False
+
+        if key is not None and self.policy == "coalesce":
+            previous = self._keyed.get(key)
+            if previous is not None:
+                # 旧帧作废，新帧排到队尾，保持与其他消息的先后顺序
+                previous.frame = None
+                self._depth -= 1
+                self.coalesced += 1
+
+        if self._depth >= self.limit:
+            if self.policy == "disconnect":
+                self._fail(f"发送队列已满（{self._depth} 帧）")
+                return False
+            if not self._drop_oldest(keyed_only=self.policy == "coalesce"):
+                # 丢弃无法合并的帧会让子服上的玩家卡在队列或对战中
+                self._fail(f"发送队列已满（{self._depth} 帧），没有可丢弃的可合并帧")
+                return False
+
+        if len(self._queue) > 2 * self.limit:
+            # 写协程停滞时作废的帧会堆积，定期压缩
+            self._queue = deque(item for item in self._queue if item.frame is not None)
+
+        item = _Item(frame, key)
+        self._queue.append(item)
+        if key is not None:
+            self._keyed[key] = item
+        self._depth += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        self._ready.set()
+        return True
+
+    def _drop_oldest(self, keyed_only: bool = False) -> bool:
+        """丢弃最早的一帧（keyed_only 时只丢带合并键的帧），没有可丢弃的帧时返回 False"""
+        if keyed_only:
+            item = next((item for item in self._queue if item.frame is not None and item.key is not None), None)
+            if item is None:
+                return False
+            item.frame = None  # 留在队列中由写协程跳过
+        else:
+            while self._queue:
+                item = self._queue.popleft()
+                if item.frame is not None:
+                    break
+            else:
+                return False
+        self._forget(item)
+        self._depth -= 1
+        self.dropped += 1
+        now = time.monotonic()
+        if now - self._drop_logged_at >= DROP_LOG_INTERVAL:
+            self._drop_logged_at = now
+            logger.warning(f"子服 {self.server_id} 发送队列已满，丢弃旧帧（该连接累计丢弃 {self.dropped} 帧）")
+        return True
+
+    def _forget(self, item: _Item):
+        if item.key is not None and self._keyed.get(item.key) is item:
+            del self._keyed[item.key]
+
+    def _fail(self, reason: str):
+        if self.closed:
+            return
+        self.close()
+        if self.on_failure:
+            self.on_failure(self.server_id, reason)
+
+    async def _run(self):
+        while not self.closed:
+            if not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            item = self._queue.popleft()
+            if item.frame is None:
+                continue
+            self._forget(item)
+            self._depth -= 1
+
+            started = time.monotonic()
+            self.latency.record("queue_wait", started - item.enqueued_at)
+            try:
+                await asyncio.wait_for(self.send(item.frame), self.send_timeout)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                self._fail(f"发送超时（{self.send_timeout} 秒）")
+                return
+            except Exception as e:
+                self._fail(f"发送失败: {e}")
+                return
+            self.latency.record("send", time.monotonic() - started)
+            self.sent += 1
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def close(self):
+        """停止写协程并丢弃未发送的帧"""
+        self.closed = True
+        self._queue.clear()
+        self._keyed.clear()
+        self._depth = 0
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    def stats(self) -> Dict:
+        return {
+            "depth": self._depth,
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            **self.latency.summary()
+        }
@@ -0,0 +1,133 @@
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from math import pow
+from typing import Dict, Optional, Set, Tuple
+
+ELO_K = 32
+DEFAULT_RATING = 1000
+RECENT_LIMIT = 100000  # 内存中记住的已结算对战数，更早的由 settlements 表判重
+RATE_WINDOW = 60.0  # 结算速率的统计窗口（秒）
+
+PLAYER_COLUMNS = "player_id, player_name, rating, wins, losses, last_server"
+
+
+def create_settlement_table(cursor: sqlite3.Cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS settlements (
+        battle_id TEXT PRIMARY KEY,
+        winner TEXT NOT NULL,
+        loser TEXT NOT NULL,
+        winner_before INTEGER NOT NULL,
+        winner_after INTEGER NOT NULL,
+        loser_before INTEGER NOT NULL,
+        loser_after INTEGER NOT NULL,
+        settled_at TEXT NOT NULL
+    ) WITHOUT ROWID""")
+
+
+def elo_update(winner_rating: int, loser_rating: int, k: int = ELO_K) -> Tuple[int, int]:
+    expected_winner = 1 / (1 + pow(10, (loser_rating - winner_rating) / 400))
+    expected_loser = 1 / (1 + pow(10, (winner_rating - loser_rating) / 400))
+    return round(winner_rating + k * (1 - expected_winner)), round(loser_rating + k * (0 - expected_loser))
+
+
+def settle_battle(conn: sqlite3.Connection, battle_id: str, winner_id: str, loser_id: str,
+                  winner_name: str, loser_name: str, settled_at: str, k: int = ELO_K) -> Optional[Dict]:
+    """在调用方的事务内结算一场对战；该对战不存在（含已归档）或已结算过时返回 None"""
+    # 重启后内存去重为空，赛季归档又会把已结算对战连同 settlements 记录移走，只能以线上对战记录为准
+    battle = conn.execute("SELECT winner FROM battles WHERE battle_id = ?", (battle_id,)).fetchone()
+    if battle is None or battle[0] is not None:
+        return None
+    if conn.execute("SELECT 1 FROM settlements WHERE battle_id = ?", (battle_id,)).fetchone():
+        return None
+
+    # 双方评分只读一次
+    rows = {
+        row["player_id"]: dict(row)
+        for row in conn.execute(f"SELECT {PLAYER_COLUMNS} FROM ratings WHERE player_id IN (?, ?)",
+                                (winner_id, loser_id))
+    }
+    winner = rows.get(winner_id) or {"player_id": winner_id, "rating": DEFAULT_RATING, "wins": 0,
+                                     "losses": 0, "last_server": None}
+    loser = rows.get(loser_id) or {"player_id": loser_id, "rating": DEFAULT_RATING, "wins": 0,
+                                   "losses": 0, "last_server": None}
+    winner_before, loser_before = winner["rating"], loser["rating"]
+    winner_after, loser_after = elo_update(winner_before, loser_before, k)
+
+    winner.update(player_name=winner_name, rating=winner_after, wins=winner["wins"] + 1)
+    loser.update(player_name=loser_name, rating=loser_after, losses=loser["losses"] + 1)
+    conn.executemany("""
+        INSERT INTO ratings (player_id, player_name, rating, wins, losses, last_active)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(player_id) DO UPDATE SET
+            player_name = excluded.player_name, rating = excluded.rating,
+            wins = excluded.wins, losses = excluded.losses, last_active = excluded.last_active
+    """, [(p["player_id"], p["player_name"], p["rating"], p["wins"], p["losses"], settled_at)
+          for p in (winner, loser)])
+
+    conn.execute("""
+        UPDATE battles
+        SET winner = ?, winner_elo_change = ?, loser_elo_change = ?
+        WHERE battle_id = ?
+    """, (winner_id, winner_after - winner_before, loser_after - loser_before, battle_id))
+
+    conn.execute("""
+        INSERT INTO settlements (battle_id, winner, loser, winner_before, winner_after, loser_before, loser_after, settled_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (battle_id, winner_id, loser_id, winner_before, winner_after, loser_before, loser_after, settled_at))
+
+    return {
+        "winner_before": winner_before,
+        "winner_after": winner_after,
+        "loser_before": loser_before,
+        "loser_after": loser_after,
+        "players": [winner, loser]
+    }
+
+
+class SettlementGuard:
+    """结算去重：进行中与近期已结算的对战直接拒绝，无需访问数据库"""
+
+    def __init__(self, recent_limit: int = RECENT_LIMIT):
+        self.recent_limit = recent_limit
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
+        self._in_flight: Set[str] = set()
+        self._settled_times = deque()
+        self.settled_total = 0
+        self.duplicates_rejected = 0
+
+    def claim(self, battle_id: str) -> bool:
+        """取得结算权；重复提交返回 False"""
+        if battle_id in self._in_flight or battle_id in self._recent:
+            self.duplicates_rejected += 1
+            return False
+        self._in_flight.add(battle_id)
+        return True
+
+    def release(self, battle_id: str):
+        """结算失败时放弃结算权，允许重试"""
+        self._in_flight.discard(battle_id)
+
+    def complete(self, battle_id: str, duplicate: bool):
+        self._in_flight.discard(battle_id)
+        self._recent[battle_id] = None
+        if len(self._recent) > self.recent_limit:
+            self._recent.popitem(last=False)
+        if duplicate:
+            # 内存中已遗忘、由 settlements 表拦下的重复提交
+            self.duplicates_rejected += 1
+        else:
+            self.settled_total += 1
+            self._settled_times.append(time.monotonic())
+
+    def summary(self) -> Dict:
+        cutoff = time.monotonic() - RATE_WINDOW
+        while self._settled_times and self._settled_times[0] < cutoff:
+            self._settled_times.popleft()
+        return {
+            "settled_total": self.settled_total,
+            "duplicates_rejected": self.duplicates_rejected,
+            "settlements_per_sec": round(len(self._settled_times) / RATE_WINDOW, 3),
+            "in_flight": len(self._in_flight)
+        }
@@ -0,0 +1,71 @@
+"""
+运行状态快照（匹配队列、在线玩家与进行中的对战）
+
+快照是 zlib 压缩的 JSON，只含字典、列表、字符串和数字；读取时只做解析，
+被篡改或损坏的快照文件最多导致恢复失败，不会执行其中的任何内容。
+"""
+import json
+import os
+import zlib
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional
+
+try:
+    import orjson
+except ImportError:  # 可选依赖，未安装时使用标准库
+    orjson = None
+
+SNAPSHOT_VERSION = 2
+MAGIC = b"CSMSNAP2"
+
+
+def encode_state(state: Dict) -> bytes:
+    """序列化为 JSON；在事件循环中调用，调用时刻即该部分状态的一致性时间点"""
+    if orjson is not None:
+        return orjson.dumps(state)
+    return json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode_state(payload: bytes) -> Dict:
+    return orjson.loads(payload) if orjson is not None else json.loads(payload)
+
+
+def with_encoded_list(head: bytes, key: str, parts: List[bytes]) -> Iterator[bytes]:
+    """逐段产出在已编码对象 head 末尾追加数组字段后的 JSON，不拼接成一整块；缓存的对战快照无需重新序列化"""
+    yield head[:-1]
+    if head != b"{}":
+        yield b","
+    yield encode_state(key) + b":["
+    for i, part in enumerate(parts):
+        if i:
+            yield b","
+        yield part
+    yield b"]}"
+
+
+def write_snapshot(path: str, chunks: Iterable[bytes]):
+    """逐段压缩并原子地写入快照文件（在线程中执行）"""
+    compressor = zlib.compressobj(1)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        for chunk in chain((b'{"version":' + str(SNAPSHOT_VERSION).encode("ascii") + b',"state":',), chunks, (b"}",)):
+            f.write(compressor.compress(chunk))
+        f.write(compressor.flush())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str) -> Optional[Dict]:
+    """读取快照，文件不存在、格式或版本不符（含旧版 pickle 快照）时返回 None"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        return None
+    snapshot = decode_state(zlib.decompress(data[len(MAGIC):]))
+    if not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    return snapshot["state"]
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import sqlite3
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+MIGRATION_CHUNK = 500  # 迁移旧对战记录时每批处理的行数
+
+
+def canonical_team(pokemons: List[Dict]) -> str:
+    """队伍的规范化 JSON：键排序、无多余空白，内容相同的队伍得到相同文本"""
+    return json.dumps(pokemons, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def team_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def encode_team(text: str, compress: bool) -> Tuple[str, bytes]:
+    raw = text.encode("utf-8")
+    if compress:
+        packed = zlib.compress(raw, 6)
+        # 很小的队伍压缩后可能反而更大
+        if len(packed) < len(raw):
+            return "zlib", packed
+    return "json", raw
+
+
+def decode_team(encoding: str, data: bytes) -> str:
+    if encoding == "zlib":
+        data = zlib.decompress(data)
+    return bytes(data).decode("utf-8")
+
+
+def create_team_table(cursor: sqlite3.Cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS teams (
+        team_hash TEXT PRIMARY KEY,
+        encoding TEXT NOT NULL,
+        data BLOB NOT NULL
+    ) WITHOUT ROWID""")
+
+
+def store_team_text(conn: sqlite3.Connection, text: str, compress: bool) -> str:
+    """按内容哈希保存队伍，已存在时不重复写入，返回哈希"""
+    key = team_hash(text)
+    encoding, data = encode_team(text, compress)
+    conn.execute("INSERT OR IGNORE INTO teams (team_hash, encoding, data) VALUES (?, ?, ?)",
+                 (key, encoding, data))
+    return key
+
+
+def store_team(conn: sqlite3.Connection, pokemons: List[Dict], compress: bool) -> str:
+    return store_team_text(conn, canonical_team(pokemons), compress)
+
+
+def load_team(conn: sqlite3.Connection, key: Optional[str]) -> Optional[str]:
+    """按哈希还原队伍 JSON"""
+    if key is None:
+        return None
+    row = conn.execute("SELECT encoding, data FROM teams WHERE team_hash = ?", (key,)).fetchone()
+    return decode_team(row[0], row[1]) if row else None
+
+
+def _store_legacy_team(conn: sqlite3.Connection, text: str, compress: bool) -> str:
+    # 旧数据先解析再规范化，保证与新写入的同一队伍得到相同哈希；无法解析时原样保存
+    try:
+        text = canonical_team(json.loads(text))
+    except ValueError:
+        pass
+    return store_team_text(conn, text, compress)
+
+
+def add_team_hash_columns(conn: sqlite3.Connection):
+    """旧库的 battles 表补上 team1_hash/team2_hash 列"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(battles)")}
+    for column in ("team1_hash", "team2_hash"):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE battles ADD COLUMN {column} TEXT")
+    conn.commit()
+
+
+def migrate_battle_teams_chunk(conn: sqlite3.Connection, compress: bool, after: int,
+                               chunk: int = MIGRATION_CHUNK) -> Tuple[int, int]:
+    """把 rowid 大于 after 的一批内联 team1/team2 迁移到 teams 表，返回 (迁移行数, 本批扫描到的最后 rowid)
+
+    按 rowid 翻页，已迁移的行不会被重复扫描；返回行数为 0 时迁移完成。
+    """
+    rows = conn.execute("""
+        SELECT rowid, battle_id, team1, team2 FROM battles
+        WHERE rowid > ? AND (team1 IS NOT NULL OR team2 IS NOT NULL)
+        ORDER BY rowid
+        LIMIT ?
+    """, (after, chunk)).fetchall()
+    if not rows:
+        return 0, after
+
+    updates = []
+    for _, battle_id, team1, team2 in rows:
+        hash1 = _store_legacy_team(conn, team1, compress) if team1 is not None else None
+        hash2 = _store_legacy_team(conn, team2, compress) if team2 is not None else None
+        updates.append((hash1, hash2, battle_id))
+    conn.executemany("""
+        UPDATE battles
+        SET team1_hash = COALESCE(?, team1_hash), team2_hash = COALESCE(?, team2_hash),
+            team1 = NULL, team2 = NULL
+        WHERE battle_id = ?
+    """, updates)
+    conn.commit()
+    return len(rows), rows[-1][0]
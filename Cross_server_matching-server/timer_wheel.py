@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger("matchmaking")
+
+
+class TimerWheel:
+    """哈希时间轮：所有定时器由一个协程驱动，到期的定时器按批次交给回调处理"""
+
+    def __init__(self, tick: float = 1.0, slots: int = 1024):
+        self.tick = tick
+        self.slots = slots
+        self._buckets: List[Set[str]] = [set() for _ in range(slots)]
+        self._timers: Dict[str, Tuple[int, Any]] = {}  # key -> (到期刻度, 附带数据)
+        self._origin = time.monotonic()
+        self._current = 0  # 已处理到的刻度
+        self._wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.expired_total = 0
+
+    def _tick_at(self, now: float) -> int:
+        return int((now - self._origin) / self.tick)
+
+    def schedule(self, key: str, delay: float, payload: Any = None):
+        """设置（或重置）定时器，delay 秒后到期"""
+        self.cancel(key)
+        now_tick = max(self._tick_at(time.monotonic()), self._current)
+        deadline = now_tick + max(1, math.ceil(delay / self.tick))
+        self._timers[key] = (deadline, payload)
+        self._buckets[deadline % self.slots].add(key)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def cancel(self, key: str) -> bool:
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        self._buckets[timer[0] % self.slots].discard(key)
+        return True
+
+    def remaining(self, key: str) -> Optional[float]:
+        """剩余秒数，定时器不存在时返回 None"""
+        timer = self._timers.get(key)
+        if timer is None:
+            return None
+        return max(0.0, timer[0] * self.tick - (time.monotonic() - self._origin))
+
+    def payload(self, key: str) -> Any:
+        timer = self._timers.get(key)
+        return timer[1] if timer else None
+
+    def advance(self, now: Optional[float] = None) -> List[Tuple[str, Any]]:
+        """推进到当前时间，返回本次到期的 (key, 附带数据) 列表"""
+        target = self._tick_at(time.monotonic() if now is None else now)
+        if target <= self._current:
+            return []
+
+        # 落后超过一圈时每个槽只需检查一次
+        first = max(self._current + 1, target - self.slots + 1)
+        expired = []
+        for t in range(first, target + 1):
+            bucket = self._buckets[t % self.slots]
+            if not bucket:
+                continue
+            for key in [k for k in bucket if self._timers[k][0] <= target]:
+                bucket.discard(key)
+                expired.append((key, self._timers.pop(key)[1]))
+        self._current = target
+        self.expired_total += len(expired)
+        return expired
+
+    def start(self, on_expire: Callable[[List[Tuple[str, Any]]], None]) -> asyncio.Task:
+        self._wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run(on_expire))
+        return self.task
+
+    async def run(self, on_expire: Callable[[List[Tuple[str, Any]]], None]):
+        while True:
+            if not self._timers:
+                # 没有定时器时不空转
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                self._current = max(self._current, self._tick_at(time.monotonic()))
+                continue
+
+            elapsed = time.monotonic() - self._origin
+            await asyncio.sleep((self._current + 1) * self.tick - elapsed)
+            expired = self.advance()
+            if expired:
+                try:
+                    on_expire(expired)
+                except Exception as e:
+                    logger.error(f"处理到期定时器失败: {e}", exc_info=True)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._timers
+
+    def __len__(self) -> int:
+        return len(self._timers)
@@ -0,0 +1,106 @@
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+GAUGES = ("online_servers", "queue_singles", "queue_doubles", "active_battles", "online_players")
+
+
+class Tier:
+    """一个汇总粒度：桶宽度与保留时长"""
+
+    def __init__(self, name: str, step: timedelta, retention: timedelta):
+        self.name = name
+        self.step = step
+        self.retention = retention
+        self.table = f"status_rollup_{name}"
+
+    def bucket_of(self, ts: datetime) -> datetime:
+        if self.step >= timedelta(days=1):
+            return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+        seconds = int(self.step.total_seconds())
+        midnight = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+        offset = int((ts - midnight).total_seconds()) // seconds * seconds
+        return midnight + timedelta(seconds=offset)
+
+
+# 由细到粗排列
+TIERS = (
+    Tier("minute", timedelta(minutes=1), timedelta(days=2)),
+    Tier("hour", timedelta(hours=1), timedelta(days=90)),
+    Tier("day", timedelta(days=1), timedelta(days=730))
+)
+TIERS_BY_NAME = {tier.name: tier for tier in TIERS}
+MAX_POINTS = 400  # 单次查询最多返回的桶数
+
+
+def create_rollup_tables(cursor: sqlite3.Cursor):
+    for tier in TIERS:
+        columns = ",\n".join(f"{g}_max INTEGER NOT NULL DEFAULT 0, {g}_sum INTEGER NOT NULL DEFAULT 0"
+                             for g in GAUGES)
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {tier.table} (
+            bucket TEXT PRIMARY KEY,
+            samples INTEGER NOT NULL DEFAULT 0,
+            {columns}
+        ) WITHOUT ROWID""")
+
+
+def record_sample(conn: sqlite3.Connection, ts: datetime, values: Dict[str, int]):
+    """把一个采样增量累加到各粒度的桶中"""
+    columns = ", ".join(f"{g}_max, {g}_sum" for g in GAUGES)
+    placeholders = ", ".join("?, ?" for _ in GAUGES)
+    updates = ", ".join(f"{g}_max = MAX({g}_max, excluded.{g}_max), {g}_sum = {g}_sum + excluded.{g}_sum"
+                        for g in GAUGES)
+    params = []
+    for g in GAUGES:
+        params.extend((values[g], values[g]))
+    for tier in TIERS:
+        conn.execute(f"""
+            INSERT INTO {tier.table} (bucket, samples, {columns})
+            VALUES (?, 1, {placeholders})
+            ON CONFLICT(bucket) DO UPDATE SET samples = samples + 1, {updates}
+        """, [tier.bucket_of(ts).isoformat()] + params)
+
+
+def prune(conn: sqlite3.Connection, now: datetime) -> int:
+    """按各粒度的保留时长删除过期的桶"""
+    removed = 0
+    for tier in TIERS:
+        cursor = conn.execute(f"DELETE FROM {tier.table} WHERE bucket < ?",
+                              ((now - tier.retention).isoformat(),))
+        removed += cursor.rowcount
+    return removed
+
+
+def choose_tier(start: datetime, end: datetime, now: datetime, max_points: int = MAX_POINTS) -> Tier:
+    """选择保留时长覆盖起点、且桶数不超过上限的最细粒度；都不满足时用最粗粒度"""
+    for tier in TIERS:
+        if start >= now - tier.retention and (end - start) / tier.step <= max_points:
+            return tier
+    return TIERS[-1]
+
+
+def query(conn: sqlite3.Connection, tier: Tier, start: datetime,
+          end: datetime) -> Tuple[List[datetime], List[int], Dict[str, Dict[str, List]]]:
+    """读取 [start, end] 内的桶，返回 (桶起点, 采样数, 各指标的 max/avg)，缺失的桶以 0 填充"""
+    first = tier.bucket_of(start)
+    buckets = []
+    current = first
+    while current <= end:
+        buckets.append(current)
+        current = tier.bucket_of(current + tier.step)
+
+    rows = conn.execute(f"""
+        SELECT * FROM {tier.table} WHERE bucket >= ? AND bucket <= ?
+    """, (first.isoformat(), end.isoformat())).fetchall()
+    by_bucket = {row["bucket"]: row for row in rows}
+
+    samples = []
+    series = {g: {"max": [], "avg": []} for g in GAUGES}
+    for bucket in buckets:
+        row = by_bucket.get(bucket.isoformat())
+        samples.append(row["samples"] if row else 0)
+        for g in GAUGES:
+            series[g]["max"].append(row[f"{g}_max"] if row else 0)
+            series[g]["avg"].append(row[f"{g}_sum"] / row["samples"] if row else 0)
+    return buckets, samples, series
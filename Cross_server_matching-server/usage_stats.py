@@ -0,0 +1,56 @@
+from heapq import nlargest
+from typing import Dict, Iterable, List, Tuple
+
+
+def normalize_pokemon_name(pokemon: Dict) -> str:
+    return pokemon.get("name", "未知宝可梦").strip().lower()
+
+
+class UsageCounter:
+    """宝可梦使用次数的内存计数，定期把增量批量写回数据库"""
+
+    def __init__(self):
+        self.totals: Dict[str, int] = {}  # 名称 -> 累计使用次数（含未写回的部分）
+        self.total_count = 0
+        self._pending: Dict[str, int] = {}  # 名称 -> 尚未写回的增量
+
+    def load(self, rows: Iterable[Tuple[str, int]]):
+        """启动时载入数据库中的累计值"""
+        for name, count in rows:
+            self.totals[name] = self.totals.get(name, 0) + count
+            self.total_count += count
+
+    def record_battle(self, player1: Dict, player2: Dict):
+        """记录一场对战，同一场对战中重复出现的宝可梦只计一次"""
+        names = {normalize_pokemon_name(p) for p in player1["pokemons"]}
+        names.update(normalize_pokemon_name(p) for p in player2["pokemons"])
+        for name in names:
+            self.totals[name] = self.totals.get(name, 0) + 1
+            self._pending[name] = self._pending.get(name, 0) + 1
+        self.total_count += len(names)
+
+    def top(self, limit: int) -> List[Dict]:
+        """使用次数最多的前 limit 个宝可梦及其使用率"""
+        total = self.total_count or 1  # 避免除以零
+        return [
+            {
+                "name": name,
+                "count": count,
+                "usage_rate": (count / total) * 100  # 计算使用率百分比
+            }
+            for name, count in nlargest(limit, self.totals.items(), key=lambda item: item[1])
+        ]
+
+    def take_pending(self) -> Dict[str, int]:
+        """取出待写回的增量"""
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def restore_pending(self, pending: Dict[str, int]):
+        """写回失败时把增量放回，下次再写"""
+        for name, count in pending.items():
+            self._pending[name] = self._pending.get(name, 0) + count
+
+    @property
+    def pending_names(self) -> int:
+        return len(self._pending)
@@ -21,7 +21,7 @@ import java.util.concurrent.ConcurrentHashMap
 import java.util.concurrent.TimeUnit
 
 object CrossServerSocket {
-    val modVersion = "1.2.0"
+    val modVersion = "1.3.0"
 
     var webSocket: WebSocket? = null
     private val config = CobblemonRanked.config
@@ -105,6 +105,16 @@ object CrossServerSocket {
         }
     }
 
+    // 一个回合的事件合并为一帧，按 seq 顺序逐个处理
+    private fun handleBattleEvents(json: JsonObject) {
+        val battleId = json["battle_id"].asString
+        json.getAsJsonArray("events").forEach { element ->
+            val event = element.asJsonObject
+            if (!event.has("battle_id")) event.addProperty("battle_id", battleId)
+            handleBattleEvent(event)
+        }
+    }
+
     private fun handleBattleEvent(json: JsonObject) {
         val eventType = json["event_type"].asString
         val battleId = json["battle_id"].asString
@@ -303,6 +313,7 @@ object CrossServerSocket {
                 val json = JsonParser.parseString(text).asJsonObject
                 when (val type = json["type"].asString) {
                     "battle_event" -> handleBattleEvent(json.getAsJsonObject("data"))
+                    "battle_events" -> handleBattleEvents(json)
                     "match_found" -> handleMatchFound(json)
                     "battle_update" -> handleBattleUpdate(json)
                     "battle_ended" -> handleBattleEnded(json)